@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+"""
+Benchmark Base64Converter.from_array, comparing the full-resolution
+normalization (slow path) with the bin-first fast path. Time and peak
+memory (from tracemalloc, numpy allocations are traced) are reported.
+
+Example:
+    python benchmark_base64_converter.py --size 4096 8192
+    python benchmark_base64_converter.py --mrc /path/to/micrograph.mrc
+"""
+
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+import mrcfile
+from emtools.utils import Pretty
+
+from emhub.utils.image import Base64Converter
+
+
+def measure(data, fast, repeat, **kwargs):
+    """ Return (best time, peak memory) of converting data. """
+    times, peak = [], 0
+    for _ in range(repeat):
+        converter = Base64Converter(**kwargs)
+        tracemalloc.start()
+        t = time.time()
+        converter.from_array(data, fast=fast)
+        times.append(time.time() - t)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def main():
+    p = argparse.ArgumentParser(prog='benchmark_base64_converter')
+    g = p.add_mutually_exclusive_group()
+    g.add_argument('--size', type=int, nargs='+', default=[4096],
+                   help="Sizes of random float32 square images")
+    g.add_argument('--mrc', nargs='+', help="Use these MRC files instead")
+    p.add_argument('--max_size', type=int, default=512)
+    p.add_argument('--contrast', type=float, default=None,
+                   help="Contrast factor (percentile cutoff)")
+    p.add_argument('--repeat', type=int, default=3)
+    args = p.parse_args()
+
+    kwargs = {'max_size': (args.max_size, args.max_size),
+              'contrast_factor': args.contrast}
+
+    if args.mrc:
+        inputs = []
+        for fn in args.mrc:
+            with mrcfile.open(fn, permissive=True) as mrc:
+                data = mrc.data if mrc.data.ndim == 2 else mrc.data[0]
+                inputs.append((fn, np.array(data)))
+    else:
+        rng = np.random.default_rng(0)
+        inputs = [(f'{s}x{s}', rng.normal(size=(s, s)).astype(np.float32))
+                  for s in args.size]
+
+    for label, data in inputs:
+        print(f"{label} ({data.dtype}, {Pretty.size(data.nbytes)})")
+        for name, fast in [('slow', False), ('fast', True)]:
+            t, peak = measure(data, fast, args.repeat, **kwargs)
+            print(f"  {name:>6}: {1000 * t:8.1f} ms, peak memory {Pretty.size(peak)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+"""
+Benchmark micrograph browsing in a live session, comparing rendering
+the micrograph and PSD thumbnails on every click (as done before) with
+loading them from the ThumbnailCache.
+
+Example:
+    python benchmark_mic_thumbnails.py /path/to/session/otf --clicks 200
+"""
+
+import time
+import random
+import tempfile
+import argparse
+
+from emtools.utils import Pretty
+
+from emhub.data.processing import get_processing_project
+from emhub.utils.image import ThumbnailCache, render_thumbnail
+
+
+def browse(mics, clicks, window, seed):
+    """ Simulate users clicking on the last micrographs of a
+    live session, going back and forth. """
+    rnd = random.Random(seed)
+    n = len(mics)
+    return [mics[rnd.randint(max(0, n - window), n - 1)] for _ in range(clicks)]
+
+
+def render_all(project, clicked, cache=None):
+    times = []
+    for mic in clicked:
+        t = time.time()
+        for fn, kind in [(mic['micrograph'], 'micrograph'),
+                         (mic['ctfImage'].replace(':mrc', ''), 'psd')]:
+            path = project.join(fn)
+            size = 512 if kind == 'micrograph' else 128
+            format = 'jpeg' if kind == 'micrograph' else 'png'
+
+            def _render(p):
+                return render_thumbnail(p, kind, size)
+
+            if cache is None:
+                ThumbnailCache.encode(_render(path), format)
+            else:
+                cache.get(path, _render, format=format,
+                          kind=kind, size=size, index=0, contrast=None)
+        times.append(time.time() - t)
+    return times
+
+
+def report(label, times):
+    times = sorted(times)
+    n = len(times)
+    print(f"{label:>12}: total {sum(times):0.2f} s, "
+          f"mean {1000 * sum(times) / n:0.1f} ms, "
+          f"p50 {1000 * times[n // 2]:0.1f} ms, "
+          f"p95 {1000 * times[int(n * 0.95)]:0.1f} ms")
+
+
+def main():
+    p = argparse.ArgumentParser(prog='benchmark_mic_thumbnails')
+    p.add_argument('project_path', help="Session processing folder (Relion or Scipion)")
+    p.add_argument('--clicks', type=int, default=100,
+                   help="Number of micrographs to view")
+    p.add_argument('--window', type=int, default=50,
+                   help="Micrographs are taken from the last WINDOW ones")
+    p.add_argument('--max_mb', type=int, default=0,
+                   help="Thumbnails cache quota (0 for no quota)")
+    p.add_argument('--cache_dir', default=None,
+                   help="Cache folder, by default a temporary one is used")
+    p.add_argument('--seed', type=int, default=0)
+    args = p.parse_args()
+
+    project = get_processing_project(args.project_path)
+    mics = list(project.get_micrographs())
+    if not mics:
+        raise Exception("No micrographs found in %s" % args.project_path)
+
+    clicked = browse(mics, args.clicks, args.window, args.seed)
+    print(f"Micrographs: {len(mics)}, clicks: {len(clicked)}, "
+          f"unique: {len(set(m['micrograph'] for m in clicked))}")
+
+    cacheDir = args.cache_dir or tempfile.mkdtemp(prefix='emhub-thumbnails-')
+    cache = ThumbnailCache(cacheDir, max_bytes=args.max_mb * 1024 * 1024)
+
+    report('no cache', render_all(project, clicked))
+    report('cache cold', render_all(project, clicked, cache))
+    report('cache warm', render_all(project, clicked, cache))
+
+    size = sum(e[2] for e in cache._entries())
+    print(f"Cache folder: {cacheDir}, size: {Pretty.size(size)}")
+
+
+if __name__ == '__main__':
+    main()
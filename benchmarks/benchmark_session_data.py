@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+"""
+Measure the bandwidth and server time of polling the live data of a
+session (api/get_session_data), as done by the session live page, comparing
+requesting the full data on every poll with the delta protocol (sending
+'since', 'since_movies' and 'version').
+
+It should run for the duration of a session (e.g. 24 hours) while it is
+being processed. If the server runs in the same machine, its pid can be
+given to also report the CPU time used by the server process.
+
+Example:
+    python benchmark_session_data.py 245 --hours 24 --interval 60 --pid 1234
+"""
+
+import sys
+import time
+import argparse
+
+from emtools.utils import Pretty
+
+from emhub.client import open_client
+
+
+class Poller:
+    def __init__(self, dc, sessionId, delta):
+        self.dc = dc
+        self.sessionId = sessionId
+        self.delta = delta
+        self.state = {}
+        self.polls = self.unchanged = self.bytes = 0
+        self.seconds = 0
+
+    def poll(self):
+        attrs = {'session_id': self.sessionId, 'result': 'micrographs'}
+        if self.delta:
+            attrs.update(self.state)
+        t = time.time()
+        r = self.dc.request('get_session_data', jsonData={'attrs': attrs})
+        self.seconds += time.time() - t
+        self.bytes += len(r.content)
+        self.polls += 1
+        data = r.json()
+        if data.get('unchanged', False):
+            self.unchanged += 1
+        else:
+            self.state = {'since': data.get('micrographs_count', 0),
+                          'since_movies': data.get('movies_count', 0),
+                          'version': data.get('version', None)}
+        return data
+
+    def report(self, label):
+        n = max(self.polls, 1)
+        print(f"{label:>6}: polls {self.polls}, unchanged {self.unchanged}, "
+              f"sent {Pretty.size(self.bytes)} ({Pretty.size(self.bytes / n)} / poll), "
+              f"time {self.seconds:0.1f} s ({1000 * self.seconds / n:0.1f} ms / poll)")
+
+
+def cpu_time(pid):
+    if pid is None:
+        return 0
+    import psutil
+    t = psutil.Process(pid).cpu_times()
+    return t.user + t.system
+
+
+def main():
+    p = argparse.ArgumentParser(prog='benchmark_session_data')
+    p.add_argument('session_id', type=int)
+    p.add_argument('--hours', type=float, default=24)
+    p.add_argument('--interval', type=int, default=60,
+                   help="Seconds between polls (as the session live page)")
+    p.add_argument('--pid', type=int, default=None,
+                   help="Pid of the server process to measure its CPU time")
+    args = p.parse_args()
+
+    with open_client() as dc:
+        pollers = [Poller(dc, args.session_id, False),
+                   Poller(dc, args.session_id, True)]
+        cpu = {False: 0, True: 0}
+        end = time.time() + args.hours * 3600
+
+        while time.time() < end:
+            for poller in pollers:
+                c = cpu_time(args.pid)
+                result = poller.poll()
+                cpu[poller.delta] += cpu_time(args.pid) - c
+                if not poller.delta:
+                    data = result  # full data, with the session status
+
+            print(f"{Pretty.now()} micrographs: {pollers[0].state.get('since', 0)}")
+            for poller in pollers:
+                poller.report('delta' if poller.delta else 'full')
+                if args.pid:
+                    print(f"{'':>8}server CPU: {cpu[poller.delta]:0.1f} s")
+            sys.stdout.flush()
+
+            if data['session']['status'] == 'finished':
+                break
+            time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -44,7 +44,8 @@ def create_app(test_config=None):
     from .blueprints import api_bp, images_bp, pages_bp
     from .utils import (datetime_to_isoformat,
                         pretty_date, pretty_datetime, pretty_quarter,
-                        send_json_data, send_error, shortname, pairname)
+                        send_json_data, send_error, shortname, pairname,
+                        LazyList)
     from .utils.mail import MailManager
 
     from emtools.utils import Pretty
@@ -88,6 +89,8 @@ def create_app(test_config=None):
     app.config["ALLOWED_IMAGE_EXTENSIONS"] = ["JPEG", "JPG", "PNG", "GIF"]
     app.config["SESSIONS"] = os.path.join(app.instance_path, 'sessions')
     app.config["PAGES"] = os.path.join(app.instance_path, 'pages')
+    app.config["THUMBNAILS"] = os.path.join(app.instance_path, 'thumbnails')
+    app.config["THUMBNAILS_MAX_MB"] = 2048  # disk quota for thumbnails
 
     if test_config is None:
         # load the instance config, if it exists, when not testing
@@ -112,6 +115,7 @@ def create_app(test_config=None):
     os.makedirs(app.config['RESOURCE_FILES'], exist_ok=True)
     os.makedirs(app.config['SESSIONS'], exist_ok=True)
     os.makedirs(app.config['PAGES'], exist_ok=True)
+    os.makedirs(app.config['THUMBNAILS'], exist_ok=True)
 
     # Define some content_id list that does not requires login
     NO_LOGIN_CONTENT = ['users_list',
@@ -139,7 +143,8 @@ def create_app(test_config=None):
         kwargs['version'] = __version__
         kwargs['emhub_title'] = app.config.get('EMHUB_TITLE', '')
 
-        kwargs['possible_booking_owners'] = app.dc.get_pi_labs()
+        # Only computed if the template uses it (e.g. the booking form)
+        kwargs['possible_booking_owners'] = LazyList(app.dc.get_pi_labs)
         kwargs['possible_operators'] = app.dc.get_possible_operators()
         kwargs['booking_types'] = app.dm.Booking.TYPES
         kwargs['currency'] = app.dm.get_config('resources').get('currency', '$')
@@ -461,6 +466,9 @@ def create_app(test_config=None):
         app.r.ping()
 
     app.dm = DataManager(app.instance_path, user=app.user, redis=app.r)
+    app.thumbnails = utils.image.ThumbnailCache(
+        app.config['THUMBNAILS'],
+        max_bytes=int(app.config['THUMBNAILS_MAX_MB']) * 1024 * 1024)
 
     from flaskext.markdown import Markdown
     Markdown(app)
@@ -51,6 +51,7 @@ import jwt
 from emtools.utils import Pretty, Color
 from emhub.utils import (datetime_from_isoformat, datetime_to_isoformat,
                          send_json_data, send_error)
+from emhub.data.processing.cache import star_cache
 
 
 api_bp = flask.Blueprint('api', __name__)
@@ -407,21 +408,22 @@ def get_bookings_range():
         func: Function used to process the booking, by default 'to_event'
     """
     d = dict(request.get_json(silent=True) or request.form)
+    funcName = d.get('func', 'to_event')
+    if funcName not in ['to_event', 'to_json']:
+        raise Exception(f"Unknown function {funcName}")
+
     bookings = app.dm.get_bookings_range(
         datetime_from_isoformat(d['start']),
-        datetime_from_isoformat(d['end'])
+        datetime_from_isoformat(d['end']),
+        eager=funcName == 'to_event'
     )
-    funcName = d.get('func', 'to_event')
+
     if funcName == 'to_event':
-        func = app.dc.booking_to_event
-    elif funcName == 'to_json':
-        def to_json(b):
-            return b.json()
-        func = to_json
+        result = app.dc.bookings_to_events(bookings)
     else:
-        raise Exception(f"Unknown function {funcName}")
+        result = [b.json() for b in bookings]
 
-    return send_json_data([func(b) for b in bookings])
+    return send_json_data(result)
 
 
 @api_bp.route('/update_booking', methods=['POST'])
@@ -540,6 +542,16 @@ def get_session_data():
 
     return handle_session_data(handle, mode="r")
 
+@api_bp.route('/get_processing_cache_stats', methods=['POST'])
+@flask_login.login_required
+def get_processing_cache_stats():
+    """ Return statistics of the cache of parsed processing files.
+    Only for admins, since it contains the paths of the cached files. """
+    if not app.user.is_admin:
+        return send_error('Only admins can get the processing cache stats.')
+    return send_json_data(star_cache.get_stats())
+
+
 @api_bp.route('/update_session_extra', methods=['POST'])
 def update_session_extra():
     """ Update only certain elements from the extra property. """
@@ -617,8 +629,10 @@ def get_session_run():
 def get_classes2d():
     """ Load 2d classification data. """
     proc = app.dm.get_processing_project(entry_id=request.form['entry_id'])
-    run = proc.get_run(request.form['run_id'])
+    project = proc['project']
+    run = project.get_run(request.form['run_id'])
     classes = run.get_classes2d(iteration=request.form.get('iteration', None))
+    app.dc.classes2d_urls(project, proc['args'], classes)
 
     return send_json_data(classes)
 
@@ -1010,8 +1024,10 @@ def handle_booking(result_key, booking_func, booking_transform=None):
 
         fix_dates(attrs, *dates)
 
-        bt = booking_transform or app.dc.booking_to_event
-        return [bt(b) for b in booking_func(**attrs)]
+        bookings = booking_func(**attrs)
+        if booking_transform is None:
+            return app.dc.bookings_to_events(bookings)
+        return [booking_transform(b) for b in bookings]
 
     return _handle_item(handle, result_key)
 
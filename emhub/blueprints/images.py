@@ -32,14 +32,111 @@ import base64
 from PIL import Image, ImageEnhance, ImageOps, ImageFilter
 
 import flask
+import flask_login
 from flask import request
 from flask import current_app as app
 
 from emhub.utils import send_json_data
+from emhub.utils.image import (ThumbnailCache, THUMBNAIL_KINDS,
+                               VOLUME_AXES, render_thumbnail, thumbnail_params,
+                               ctf_profile_list, render_volume_slice,
+                               volume_info as read_volume_info)
 
 
 images_bp = flask.Blueprint('images', __name__)
 
+# Max-age used for thumbnails, their URLs change if the source image changes
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600
+THUMBNAIL_SIZES = [48, 64, 100, 128, 256, 512, 1024]
+
+
+def _set_cache_headers(response, etag, max_age):
+    response.set_etag(etag)
+    response.cache_control.max_age = max_age
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+
+def send_thumbnail(path, render, format='png', max_age=THUMBNAIL_MAX_AGE,
+                   shared=None, **params):
+    """ Send the thumbnail of a given image with ETag and cache headers.
+
+    The ETag is the thumbnail cache key (from path, mtime, size and params),
+    so if the client already has it, a 304 is returned without rendering.
+    If a shared cache is given (e.g. written by the session worker), it is
+    read first and the thumbnail is only rendered if not found there.
+    """
+    if not os.path.exists(path):
+        flask.abort(404)
+
+    if format not in ThumbnailCache.FORMATS:
+        flask.abort(400)
+
+    cache, cachePath = app.thumbnails, None
+    if shared is not None:
+        cachePath, etag = shared.lookup(path, format=format, **params)
+        if cachePath:
+            cache = shared
+
+    if cachePath is None:
+        etag = cache.get_key(path, format=format, **params)
+
+    if etag in request.if_none_match:
+        return _set_cache_headers(flask.Response(status=304), etag, max_age)
+
+    if cachePath is None:
+        cachePath, etag = cache.get(path, render, format=format, **params)
+
+    response = flask.send_file(cachePath, mimetype='image/%s' % format,
+                               conditional=False, etag=False, max_age=max_age)
+    return _set_cache_headers(response, etag, max_age)
+
+
+def _check_entry_access(entry):
+    """ Same permissions as to see the entry's project details. """
+    user = app.user
+    project = entry.project
+    if not (user.can_edit_project(project) or user.same_pi(project.user)):
+        flask.abort(403)
+
+
+def _project_args(args):
+    """ Return the args to load a processing project, from a session_id
+    or entry_id (paths are not accepted from clients), after checking
+    that the current user has access to that session or entry.
+    """
+    dm = app.dm  # shortcut
+    user = app.user
+
+    if 'session_id' in args:
+        session = dm.get_session_by(id=int(args['session_id']))
+        if session is None:
+            flask.abort(404)
+        a = session.booking.application if session.booking else None
+        if not (a is None or a.allows_access(user)):
+            flask.abort(403)
+        return {'session_id': session.id}
+
+    if 'entry_id' in args:
+        entry = dm.get_entry_by(id=int(args['entry_id']))
+        if entry is None:
+            flask.abort(404)
+        _check_entry_access(entry)
+        return {'entry_id': entry.id}
+
+    flask.abort(400)
+
+
+def _image_args(kind):
+    """ Read size and format from the request, with defaults for each kind. """
+    defaults = THUMBNAIL_KINDS[kind]
+    size = int(request.args.get('size', defaults['size']))
+    if size not in THUMBNAIL_SIZES:
+        flask.abort(400)
+    return size, request.args.get('format', defaults['format'])
+
 
 @images_bp.route("/static", methods=['GET', 'POST'])
 def static():
@@ -65,6 +162,83 @@ def user_profile():
         flask.abort(404)
 
 
+@images_bp.route("/resource_image", methods=['GET'])
+@flask_login.login_required
+def resource_image():
+    """ Return a thumbnail of the image of a given resource.
+    Input: resource_id, size (optional, default 128) and v (version,
+        only used to change the URL when the image is updated).
+    """
+    resource = app.dm.get_resource_by(id=int(request.args['resource_id']))
+    size = int(request.args.get('size', 128))
+    if resource is None or size not in THUMBNAIL_SIZES:
+        flask.abort(404)
+
+    def _render(path):
+        return render_thumbnail(path, 'image', size)
+
+    fn = app.dm.get_resource_image_path(resource)
+    return send_thumbnail(fn, _render, kind='image', size=size)
+
+
+@images_bp.route("/entry_image", methods=['GET'])
+@flask_login.login_required
+def entry_image():
+    """ Return a thumbnail of an image file of a given entry.
+    Input: entry_id, filename, size and format (optional) and v (version).
+    """
+    entry = app.dm.get_entry_by(id=int(request.args['entry_id']))
+    if entry is None:
+        flask.abort(404)
+    _check_entry_access(entry)
+
+    size, format = _image_args('image')
+
+    def _render(path):
+        return render_thumbnail(path, 'image', size)
+
+    filename = os.path.basename(request.args['filename'])
+    fn = app.dm.get_entry_path(entry, filename)
+    return send_thumbnail(fn, _render, format=format, kind='image', size=size)
+
+
+@images_bp.route("/processing_image", methods=['GET'])
+@flask_login.login_required
+def processing_image():
+    """ Render a thumbnail from an image of a processing project.
+    Input: session_id or entry_id (to load the project),
+        file (relative to the project), kind (micrograph, psd, class2d
+        or image), and optional: size, format, index (image in a stack),
+        contrast (autocontrast cutoff) and v (version, only used to
+        change the URL when the file changes)
+    """
+    args = request.args
+    kind = args.get('kind', 'image')
+    if kind not in THUMBNAIL_KINDS:
+        flask.abort(400)
+
+    size, format = _image_args(kind)
+    contrast = args.get('contrast', None)
+    params = thumbnail_params(kind, size=size, format=format,
+                              index=args.get('index', 0),
+                              contrast=None if contrast == 'None' else contrast)
+    project = app.dm.get_processing_project(**_project_args(args))['project']
+
+    # Only allow files inside the project folder
+    root = os.path.normpath(project.join(''))
+    path = os.path.normpath(project.join(args['file']))
+    if not path.startswith(root + os.sep):
+        flask.abort(403)
+
+    def _render(path):
+        return render_thumbnail(path, kind, size, index=params['index'],
+                                contrast=params['contrast'])
+
+    # Thumbnails pre-generated by the session worker are read first
+    shared = ThumbnailCache.shared(root)
+    return send_thumbnail(path, _render, shared=shared, **params)
+
+
 @images_bp.route("/get_mic_data", methods=['POST'])
 def get_mic_data():
     """ Load micrograph data from a given micId.
@@ -76,8 +250,18 @@ def get_mic_data():
     """
     kwargs = request.form.to_dict()
     micId = int(kwargs['mic_id'])
-    run = app.dm.get_processing_project(**kwargs)['run']
-    mic = run.get_micrograph_data(micId)
+    proc = app.dm.get_processing_project(**kwargs)
+    project = proc['project']
+    source = proc['run'] if 'run' in proc else project
+    mic = source.get_micrograph_data(micId)
+
+    # Images are loaded by the client from the (cached) images URLs
+    if 'micFile' in mic:
+        mic['micThumbUrl'] = app.dc.processing_image_url(
+            project, proc['args'], mic.pop('micFile'), 'micrograph')
+    if 'psdFile' in mic:
+        mic['psdUrl'] = app.dc.processing_image_url(
+            project, proc['args'], mic.pop('psdFile'), 'psd')
 
     if 'coordinates' in mic:
         if not isinstance(mic['coordinates'], list):  # numpy arrays
@@ -85,6 +269,9 @@ def get_mic_data():
     else:
         mic['coordinates'] = []
 
+    if 'ctfPlot' in mic:
+        mic['ctfPlot'] = ctf_profile_list(mic['ctfPlot'])
+
     return send_json_data(mic)
 
 
@@ -92,27 +279,71 @@ def get_mic_data():
 def get_micrograph_gridsquare():
     form = request.form  # shortcut
     sessionId = int(form['session_id'])
-    session = app.dm.load_session(sessionId)
+    proc = app.dm.get_processing_project(session_id=sessionId)
+    project = proc['project']
     kwargs = {}
     if 'gsId' in form:
         kwargs['gsId'] = form['gsId']
     if 'fhId' in form:
         kwargs['fhId'] = form['fhId']
-    data = session.data.get_micrograph_gridsquare(**kwargs)
-    session.data.close()
+    data = project.get_micrograph_gridsquare(**kwargs)
+    gs = data['gridSquare']
+    if 'imageFile' in gs:
+        gs['thumbnail'] = app.dc.processing_image_url(
+            project, proc['args'], gs.pop('imageFile'), 'image')
     return send_json_data(data)
 
 
-@images_bp.route("/get_volume_data", methods=['POST'])
-def get_volume_data():
-    """ Load volume data from a given run and output name.
-    Input: projectId, runId, volName
+def _volume_path(args):
+    """ Load the run from the request args and return the path
+    of the given volume (one of the run outputs). """
+    proc = app.dm.get_processing_project(run_id=args['run_id'],
+                                         **_project_args(args))
+    volName = os.path.basename(args['volName'])
+    volPath = proc['run'].join(volName)
+    if not os.path.exists(volPath):
+        flask.abort(404)
+    return proc, volName, volPath
+
+
+@images_bp.route("/volume_info", methods=['GET'])
+@flask_login.login_required
+def volume_info():
+    """ Return the dimensions (x, y, z), pixel size and data range of a
+    volume, without reading its data. Slices are then loaded one by one
+    from images.volume_slice.
+    The version (file mtime) should be added to the slices URLs (as v),
+    so they change if the volume is written again.
+    Input: session_id or entry_id, run_id and volName
     """
-    dm = app.dm
-    kwargs = request.form.to_dict()
-    volName = kwargs['volName']
-    axis = kwargs.get('axis', 'z')
-    run = dm.get_processing_project(**kwargs)['run']
-    vol = run.get_volume_data(volName, volume_data='slices', axis=axis)
+    proc, volName, volPath = _volume_path(request.args)
+    return send_json_data(dict(read_volume_info(volPath), volName=volName,
+                               version=int(os.path.getmtime(volPath))))
+
+
+@images_bp.route("/volume_slice", methods=['GET'])
+@flask_login.login_required
+def volume_slice():
+    """ Render a single slice of a volume as a PNG image. Only that slice
+    is read from the (memory-mapped) file and the same contrast (from
+    the range of the volume) is used for all slices.
+    Input: same as volume_info, axis (x, y or z), index, size (optional)
+        and v (version, only used to change the URL when the file changes)
+    """
+    args = request.args
+    proc, volName, volPath = _volume_path(args)
+    axis = args.get('axis', 'z')
+    size = args.get('size', 256, type=int)
+    index = args.get('index', None, type=int)  # None if missing or invalid
+    if axis not in VOLUME_AXES or size not in THUMBNAIL_SIZES or index is None:
+        flask.abort(400)
+
+    dims = read_volume_info(volPath)['dimensions']
+    if not 0 <= index < dims[2 - VOLUME_AXES[axis]]:
+        flask.abort(404)
+
+    def _render(path):
+        return render_volume_slice(path, axis, index, size)
 
-    return send_json_data(vol)
+    return send_thumbnail(volPath, _render, format='png', kind='volume_slice',
+                          axis=axis, index=index, size=size)
@@ -22,26 +22,68 @@ import shutil
 import logging
 import argparse
 import threading
+import multiprocessing
 from datetime import datetime, timedelta
 from glob import glob
 from collections import OrderedDict
 import configparser
 from pprint import pprint
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from emtools.utils import Pretty, Process, Path, Color, System
 from emtools.metadata import EPU, MovieFiles, StarFile
 
 from emhub.client import config
+from emhub.utils.image import (ThumbnailCache, render_thumbnail, thumbnail_params,
+                               load_ctf_profile, ctf_profile_path)
 from emhub.client.worker import (TaskHandler, DefaultTaskHandler, CmdTaskHandler,
                                  Worker)
 
 
+def render_otf_thumbnails(projectPath, files):
+    """ Render thumbnails into the shared cache of a processing project.
+    This function runs in the process pool of the session worker.
+
+    Args:
+        projectPath: root folder of the processing project
+        files: list of (filename, kind) pairs, filenames relative to the project.
+            Kind 'ctf_profile' is used for ctffind _avrot.txt files.
+    Returns:
+        the number of thumbnails in the cache after this call.
+    """
+    cache = ThumbnailCache.shared(projectPath, create=True)
+    n = 0
+    for fn, kind in files:
+        path = os.path.join(projectPath, fn)
+        if not os.path.exists(path):
+            continue
+        if kind == 'ctf_profile':
+            load_ctf_profile(path, cache=cache)
+            n += 1
+            continue
+        params = thumbnail_params(kind)
+
+        def _render(p):
+            return render_thumbnail(p, kind, params['size'],
+                                    contrast=params['contrast'])
+
+        cache.get(path, _render, **params)
+        n += 1
+    return n
+
+
 class SessionTaskHandler(TaskHandler):
     def __init__(self, *args, **kwargs):
         TaskHandler.__init__(self, *args, **kwargs)
         self.mf = None
         self.epu_session = None  # for EPU parsing during OTF
+        # For pre-generating thumbnails during OTF
+        self.thumbs_pool = None
+        self.thumbs_futures = []  # (future, micrographs, retry) of each batch
+        self.thumbs_mics = set()  # micrographs with rendered thumbnails
+        self.thumbs_seen = 0  # micrographs read from the project
         self.update_session = False
 
         targs = self.task['args']
@@ -385,6 +427,8 @@ class SessionTaskHandler(TaskHandler):
 
         if clear:
             self.stop_all_otf(done=False)
+            self.thumbs_mics.clear()
+            self.thumbs_seen = 0
 
         try:
             n = raw.get('movies', 0)
@@ -434,6 +478,9 @@ class SessionTaskHandler(TaskHandler):
                     self.info(f"No longer need to update session.")
                     self.update_session = False  # after launching no need to update
 
+            if otf_exists:
+                self.otf_thumbnails(otf_path)
+
         except Exception as e:
             self.worker.logger.exception(e)
             self.update_task({
@@ -442,6 +489,89 @@ class SessionTaskHandler(TaskHandler):
             })
             self.stop()
 
+    def otf_thumbnails(self, otf_path):
+        """ Render micrograph and PSD thumbnails of new micrographs in the
+        OTF project, in a pool of processes. Thumbnails are written in the
+        shared cache of the project, that is read first by the web server.
+
+        The number of processes is taken from the 'thumbnails_workers'
+        option of the 'otf' sessions config (default 2, 0 to disable).
+        Micrographs of a failed batch are submitted once more.
+        """
+        workers = self.sconfig['otf'].get('thumbnails_workers', 2)
+        if not workers:
+            return
+
+        # Do not submit new work until the previous batch is done
+        pending = [f for f, _, _ in self.thumbs_futures if not f.done()]
+        if pending:
+            self.info(f"Thumbnails: {len(pending)} batches still running.")
+            return
+
+        rendered = 0
+        retry = []
+        for f, mics, retried in self.thumbs_futures:
+            try:
+                rendered += f.result()
+                self.thumbs_mics.update(micFn for micFn, _ in mics)
+            except Exception as e:
+                self.error(f"Thumbnails batch failed: {e}")
+                if not retried:
+                    retry.extend(mics)
+                if isinstance(e, BrokenProcessPool) and self.thumbs_pool is not None:
+                    self.thumbs_pool.shutdown(wait=False)
+                    self.thumbs_pool = None
+        self.thumbs_futures = []
+
+        try:
+            # Load the project lazily, only needed here and it imports the
+            # whole data module
+            from emhub.data.processing import get_processing_project
+            project = get_processing_project(otf_path)
+            mics = []
+            for mic in project.get_micrographs(start=self.thumbs_seen):
+                psdFn = mic['ctfImage'].replace(':mrc', '')
+                mics.append((mic['micrograph'], [(mic['micrograph'], 'micrograph'),
+                                                 (psdFn, 'psd'),
+                                                 (ctf_profile_path(psdFn), 'ctf_profile')]))
+            self.thumbs_seen += len(mics)
+        except Exception as e:
+            # The OTF project might not be ready yet, try again later
+            self.info(f"Thumbnails: could not read micrographs, error: {e}")
+            mics = []
+
+        def _submit(mics, retried):
+            batch = max(1, len(mics) // workers)
+            for i in range(0, len(mics), batch):
+                batchMics = mics[i:i + batch]
+                files = [f for _, micFiles in batchMics for f in micFiles]
+                future = self.thumbs_pool.submit(render_otf_thumbnails,
+                                                 otf_path, files)
+                self.thumbs_futures.append((future, batchMics, retried))
+
+        if mics or retry:
+            if self.thumbs_pool is None:
+                # Spawn the processes, forking this multi-threaded worker
+                # could leave locks held by other threads in the children
+                self.thumbs_pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            _submit(mics, False)
+            _submit(retry, True)
+
+        self.info(f"Thumbnails: rendered {rendered}, new micrographs "
+                  f"{len(mics)}, retried {len(retry)}, "
+                  f"{len(self.thumbs_futures)} batches, "
+                  f"total micrographs: {len(self.thumbs_mics)}")
+
+    def stop(self):
+        """ Stop the thumbnails pool (if any) and the thread. """
+        if self.thumbs_pool is not None:
+            self.thumbs_pool.shutdown(wait=False, cancel_futures=True)
+            self.thumbs_pool = None
+            self.thumbs_futures = []
+        TaskHandler.stop(self)
+
     def create_otf_folder(self, otf_path, update_session=True):
         extra = self.session['extra']
         raw_path = extra['raw']['path']
@@ -643,12 +773,60 @@ class FramesTaskHandler(TaskHandler):
         time.sleep(30)
 
 
+class IndexerTaskHandler(TaskHandler):
+    """ Follow the active sessions and keep the summary of their processing
+    projects up to date (see SessionSummary), so the web server does not
+    need to read the output files on every request. Thumbnails are not
+    rendered here, but by the session task (see otf_thumbnails).
+
+    When the summary of a session changes, its new version is published
+    as an event of this task.
+    """
+    def __init__(self, *args, **kwargs):
+        TaskHandler.__init__(self, *args, **kwargs)
+        self.sleep = self.task['args'].get('sleep', 60)
+        self.versions = {}
+
+    def index_session(self, session):
+        """ Update the summary of a session, return its version. """
+        # Loaded lazily, as in otf_thumbnails, it imports the whole data module
+        from emhub.data.processing import get_processing_project
+        from emhub.data.processing.summary import SessionSummary
+
+        path = session.get('data_path', None)
+        if not path or not os.path.exists(path):
+            return None
+
+        project = get_processing_project(path)
+        summary = SessionSummary(path)
+        return summary.write(SessionSummary.build(project))
+
+    def process(self):
+        sessions = self._request(self.dc.get_active_sessions,
+                                 'retrieving active sessions') or []
+        for session in sessions:
+            sid = session['id']
+            try:
+                version = self.index_session(session)
+            except Exception as e:
+                self.error(f"Indexing session {sid}: {e}")
+                if self.worker.debug:
+                    self.error(traceback.format_exc())
+                continue
+
+            if version is not None and version != self.versions.get(sid, None):
+                self.versions[sid] = version
+                self.info(f"Session {sid} summary, version: {version}")
+                self.update_task({'session_id': sid, 'summary_version': version})
+
+
 class SessionWorker(Worker):
     def handle_tasks(self, tasks):
         handlers = {
             'command': CmdTaskHandler,
             'session': SessionTaskHandler,
-            'frames': FramesTaskHandler
+            'frames': FramesTaskHandler,
+            'indexer': IndexerTaskHandler
         }
 
         for t in tasks:
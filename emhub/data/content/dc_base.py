@@ -29,6 +29,7 @@
 import os
 import datetime as dt
 import json
+import hashlib
 import sys
 from collections import defaultdict
 from glob import glob
@@ -39,11 +40,13 @@ from flask import current_app as app
 
 from emhub.utils import (pretty_datetime, datetime_to_isoformat, pretty_date,
                          datetime_from_isoformat, get_quarter, pretty_quarter,
-                         image, shortname)
+                         shortname, image)
 
 from emtools.utils import Pretty
 from emtools.metadata import Bins, TsBins, EPU
 
+from emhub.data.processing.ctf_store import get_ctf_store, array_bins
+
 
 class DataContent:
     """ This class acts as an intermediary between the DataManager and
@@ -187,113 +190,28 @@ class DataContent:
 
         return pi_user
 
-    def booking_to_event(self, booking, **kwargs):
-        """ Return a dict that can be used as calendar Event object. """
-        resource = booking.resource
-        # Bookings should have resources, just in case an erroneous one
-        if resource is None:
-            resource = self.app.dm.Resource(
-                name='Error: MISSING',
-                status='inactive',
-                tags='',
-                image='',
-                color='rgba(256, 256, 256, 1.0)',
-                extra={})
-
-        owner = booking.owner
-        operator = booking.operator  # shortcut
-        creator = booking.creator
-        a = booking.application
-        user = self.app.user
-        dm = self.app.dm
-        b_title = booking.title
-        b_description = booking.description
-
-        user_can_book = False
-        # Define which users are allowed to modify the booking
-        # - managers
-        # - application creators
-        # - the owner and pi of the owner
-        can_modify_list = [owner.id]
-
-        if a is not None:
-            can_modify_list.append(a.creator.id)
-
-        if user.is_manager and (a is None or a.allows_access(user)):
-            can_modify_list.append(user.id)
-
-        pi = owner.get_pi()
-        if pi is not None:
-            can_modify_list.append(pi.id)
-
-        user_can_modify = user.id in can_modify_list
-        user_can_view = user_can_modify or user.same_pi(owner)
-        color = resource.color if resource else 'grey'
-
-        application_label = 'None'
-
-        if booking.type == 'special':
-            color = 'rgba(98,50,45,1.0)'
-            title = "%s (SPECIAL): %s" % (resource.name, b_title)
-        if booking.type == 'downtime':
-            color = 'rgba(181,4,0,1.0)'
-            title = "%s (DOWNTIME): %s" % (resource.name, b_title)
-        if booking.type == 'maintenance' or any(k in b_title for k in ['cycle', 'installation', 'maintenance', 'afis']):
-            color = 'rgba(255,107,53,1.0)'
-            title = "%s (MAINTENANCE): %s" % (resource.name, b_title)
-        elif booking.type == 'slot':
-            color = color.replace('1.0', '0.5')  # transparency for slots
-            title = "%s (SLOT): %s" % (resource.name,
-                                       booking.slot_auth.get('applications', ''))
-            user_can_book = user.can_book_slot(booking)
-        else:
-            # Show all booking information in title in some cases only
-            display = dm.get_config('bookings')['display']
-            emptyApp = a is None or not display['show_application']
-            appStr = '' if emptyApp else ', %s' % a.code
-            emptyPi = (owner.is_manager or owner.is_pi or
-                       pi is None or not display.get('show_pi', False))
-            piStr = '' if emptyPi else shortname(pi) + '/'
-            emptyOp = operator is None or not display.get('show_operator', False)
-            opStr = '' if emptyOp else ' -> ' + shortname(operator)
-
-            extra = "%s%s%s%s" % (piStr, shortname(owner), appStr, opStr)
-            if user_can_view:
-                title = "%s (%s) %s" % (resource.name, extra, b_title)
-                if a:
-                    application_label = a.code
-                    if a.alias:
-                        application_label += "  (%s)" % a.alias
-            else:
-                title = "%s (%s)" % (resource.name, extra)
-                b_title = "Hidden title"
-                b_description = "Hidden description"
+    def get_booking_serializer(self):
+        """ Return the BookingSerializer for the current request.
 
-        bd = {
-            'id': booking.id,
-            'title': title,
-            'resource': {'id': resource.id},
-            'start': datetime_to_isoformat(booking.start),
-            'end': datetime_to_isoformat(booking.end),
-            'color': color,
-            'textColor': 'white',
-            'booking_title': b_title,
-        }
-
-        if kwargs.get('prettyDate', False):
-            bd['pretty_start'] = pretty_datetime(booking.start)
-            bd['pretty_end'] = pretty_datetime(booking.end)
+        The serializer is created once per request (stored in flask.g)
+        so the config, user and permission context are only resolved once.
+        """
+        if not flask.has_request_context():
+            return BookingSerializer(self.app.dm, self.app.user)
 
-        if kwargs.get('piApp', False):
-            if pi is not None:
-                bd['pi_id'] = pi.id
-                bd['pi_name'] = pi.name
+        serializer = flask.g.get('booking_serializer', None)
+        if serializer is None:
+            serializer = BookingSerializer(self.app.dm, self.app.user)
+            flask.g.booking_serializer = serializer
+        return serializer
 
-            app = booking.application
-            if app is not None:
-                bd['app_id'] = app.id
+    def booking_to_event(self, booking, **kwargs):
+        """ Return a dict that can be used as calendar Event object. """
+        return self.get_booking_serializer().to_event(booking, **kwargs)
 
-        return bd
+    def bookings_to_events(self, bookings, **kwargs):
+        """ Return the list of calendar Event dicts for the given bookings. """
+        return self.get_booking_serializer().serialize(bookings, **kwargs)
 
     def booking_from_entry(self, entry, scopes):
         """ Create a booking instance from an existing entry of type
@@ -440,55 +358,41 @@ class DataContent:
         # 3) Other users can not change the ownership
         # If all = True, all labs will be returned
         user = self.app.user  # shortcut
-        dm = self.app.dm
 
         if not user.is_authenticated:
             return []
 
+        directory = self.app.dm.get_lab_directory()
+
         if user.is_manager or all:
-            piList = [u for u in dm.get_users(condition='status="active"') if u.is_pi]
+            piIds = directory.active_pis
         elif user.is_application_manager:
-            apps = [a for a in user.created_applications if a.is_active]
-            piSet = {user.get_id()}
-            piList = [user]
-            for a in apps:
-                for pi in a.users:
-                    if pi.get_id() not in piSet:
-                        piList.append(pi)
+            piIds = [user.id] + [piId for piId in directory.app_pis.get(user.id, [])
+                                 if piId != user.id]
         elif user.is_pi:
-            piList = [user]
+            piIds = [user.id]
         else:
-            piList = []
-
-        def _userjson(u):
-            return {'id': u.id, 'name': u.name}
+            piIds = []
 
         # Group users by PI
-        labs = []
-        for u in piList:
-            if u.is_pi:
-                lab = [_userjson(u)] + [_userjson(u2) for u2 in u.get_lab_members()]
-                labs.append(lab)
+        labs = directory.get_labs(piIds)
 
         # Group managers by staff units
         if user.is_manager:
-            for unit in dm.get_staff_units():
-                unit_members = [_userjson(u) for u in self._get_facility_staff(unit)]
-                if unit_members:
-                    labs.append(unit_members)
+            labs.extend(directory.get_staff())
 
         return labs
 
     def get_possible_operators(self):
-        dm = self.app.dm
+        user = self.app.user  # shortcut
 
-        if self.app.user.is_authenticated and self.app.user.is_manager:
-            return [{'id': u.id, 'name': u.name}
-                    for u in dm.get_users() if 'manager' in u.roles]
+        if user.is_authenticated and user.is_manager:
+            return list(self.app.dm.get_lab_directory().managers)
         return []
 
     def get_booking_in_range(self, kwargs,
-                             asJson=True, filter=None, bookingFunc=None):
+                             asJson=True, filter=None, bookingFunc=None,
+                             extra=None):
         """ Return the list of bookings in the given time range.
 
          It will also attach PI information to each booking.
@@ -502,7 +406,11 @@ class DataContent:
              filter: function to filter bookings. If None, the non-slot bookings
                 with non-zero cost resource will be used.
             bookingFunc: if asJson is True, function used to convert
-                booking into a jsonDict. If it is none, booking_to_event is used.
+                booking into a jsonDict. If it is none, the request
+                BookingSerializer is used.
+            extra: function (booking) -> dict with extra values that
+                will be added to each booking json (only used when
+                bookingFunc is None).
         """
 
         if 'start' in kwargs and 'end' in kwargs:
@@ -525,21 +433,23 @@ class DataContent:
 
         bookings = self.app.dm.get_bookings_range(
             datetime_from_isoformat(d['start'].replace('/', '-')),
-            datetime_from_isoformat(d['end'].replace('/', '-'))
+            datetime_from_isoformat(d['end'].replace('/', '-')),
+            eager=asJson
         )
 
-        bookingFunc = bookingFunc or self.booking_to_event
-
-        def process_booking(b):
-            if not asJson:
-                return b
-            return bookingFunc(b, prettyDate=True, piApp=True)
-
         def _filter(b):
             return b.resource.daily_cost > 0 and not b.is_slot
 
         filterFunc = filter or _filter
-        bookings = [process_booking(b) for b in bookings if filterFunc(b)]
+        bookings = [b for b in bookings if filterFunc(b)]
+
+        if asJson:
+            if bookingFunc is None:
+                bookings = self.bookings_to_events(bookings, prettyDate=True,
+                                                   piApp=True, extra=extra)
+            else:
+                bookings = [bookingFunc(b, prettyDate=True, piApp=True)
+                            for b in bookings]
 
         return bookings, d
 
@@ -559,8 +469,10 @@ class DataContent:
 
             fn = dm.get_resource_image_path(r)
             if os.path.exists(fn):
-                base64 = image.Base64Converter(max_size=(128, 128))
-                return 'data:image/%s;base64, ' + base64.from_path(fn)
+                # Thumbnails are cached on disk and by the browser,
+                # the version changes the url when the image is updated
+                return flask.url_for('images.resource_image', resource_id=r.id,
+                                     v=int(os.path.getmtime(fn)))
             else:
                 return flask.url_for('images.static', filename=r.image)
 
@@ -693,8 +605,75 @@ class DataContent:
                 'extra_columns': extra_columns
                 }
 
+    def processing_image_url(self, project, projectArgs, filename, kind, **kwargs):
+        """ Return the URL to render an image from a processing project.
+
+        Args:
+            project: processing project (SessionData) containing the image.
+            projectArgs: args used to load the project (session_id or
+                entry_id), extra keys (e.g. run_id) are ignored. Projects
+                loaded from a path can not be accessed from the images
+                endpoints.
+            filename: image path relative to the project folder.
+            kind: thumbnail kind (micrograph, psd, class2d or image).
+            kwargs: other image params (size, format or index).
+        """
+        path = project.join(filename)
+        # The file mtime is included to change the URL if the file changes
+        version = int(os.path.getmtime(path)) if os.path.exists(path) else 0
+        args = {k: v for k, v in projectArgs.items()
+                if k in ['session_id', 'entry_id']}
+        args.update(kwargs)
+        return flask.url_for('images.processing_image', file=filename,
+                             kind=kind, v=version, **args)
+
+    def classes2d_urls(self, project, projectArgs, items, sprite=True):
+        """ Set the image URLs of 2D classes items with 'file' and 'index'.
+
+        If sprite is True, all averages of a stack are rendered in a single
+        sheet, each item gets the 'sprite' URL and its 'tile' in the sheet
+        (x, y, width, height). If not, each item gets an 'average' URL.
+        """
+        sprites = {}
+        for item in items:
+            if 'file' not in item:
+                continue
+            fn, index = item.pop('file'), item.pop('index', 0)
+            if not sprite:
+                item['average'] = self.processing_image_url(
+                    project, projectArgs, fn, 'class2d', index=index)
+                continue
+
+            if fn not in sprites:
+                size = image.THUMBNAIL_KINDS['class2d_sprite']['size']
+                n = image.stack_size(project.join(fn))
+                sprites[fn] = (self.processing_image_url(
+                    project, projectArgs, fn, 'class2d_sprite'),
+                    image.sprite_tiles(n, size))
+            url, tiles = sprites[fn]
+            item['sprite'] = url
+            item['tile'] = tiles[index]
+        return items
+
     def get_session_data(self, session, **kwargs):
+        """ Return processing data of a session.
+
+        For result='micrographs', 'since' and 'since_movies' can be given
+        with the number of micrographs (and EPU movies) that the client
+        already has. Then the arrays only contain the new rows, while the
+        stats and bins are always computed for all micrographs. If the
+        client has more rows than the server (e.g. CTF was run again and
+        the values were read from the beginning), all rows are returned
+        with since=0, so the client replaces its data.
+
+        The result has a 'version' of the session and stats. If the client
+        sends the version it has and there are no new micrographs, only
+        {'unchanged': True, 'version': version} is returned.
+        """
         result = kwargs.get('result', 'micrographs')
+        since = int(kwargs.get('since', 0))
+        sinceMovies = int(kwargs.get('since_movies', 0))
+        clientVersion = kwargs.get('version', None)
 
         defocus = []
         defocusAngle = []
@@ -705,10 +684,8 @@ class DataContent:
         tsRange = {}
         beamshifts = []
 
-        sdata = self.app.dm.get_processing_project(session_id=session.id)['project']
-
-        def _microns(v):
-            return round(v * 0.0001, 3)
+        proc = self.app.dm.get_processing_project(session_id=session.id)
+        sdata = proc['project']
 
         def _ts(fn):
             return os.path.getmtime(sdata.join(fn))
@@ -725,47 +702,62 @@ class DataContent:
         data['stats'] = sdata.get_stats()
 
         if result == 'micrographs':
+            # Changes when the session (e.g. status or OTF info) or stats change
+            dataStr = json.dumps(data, sort_keys=True, default=str)
+            version = hashlib.sha1(dataStr.encode()).hexdigest()[:16]
+            if (since and clientVersion == version
+                    and since == data['stats']['ctfs']['count']):
+                return {'unchanged': True, 'version': version,
+                        'since': since, 'since_movies': sinceMovies}
+
             firstMic = lastMic = None
             dbins = Bins([1, 2, 3])
             rbins = Bins([3, 4, 6])
-            epuData = None
+            epuMovies = None
 
             if data['stats']['ctfs']['count'] > 0:
-                for mic in sdata.get_micrographs():
-                    micFn = mic['micrograph']
-                    micName = mic.get('micName', micFn)
-                    loc = EPU.get_movie_location(micName)
-                    gridsquares.append(loc['gs'])
-                    if not defocus:
-                        firstMic = micFn
-                    lastMic = micFn
-                    d = _microns(mic['ctfDefocus'])
-                    defocus.append(d)
-                    dbins.addValue(d)
-                    defocusAngle.append(mic['ctfDefocusAngle'])
-                    astigmatism.append(_microns(mic['ctfAstigmatism']))
-                    r = round(mic['ctfResolution'], 3)
-                    resolution.append(r)
-                    rbins.addValue(r)
+                # Columnar CTF values, only new micrographs are read
+                store = get_ctf_store(sdata.join(''))
+                store.update(sdata, data['stats']['ctfs']['count'],
+                             grow_only='summary' in data['stats'])
+                total = store.count
+                movies = sdata.get_epu_movies()
+                if since > total or (movies is not None and sinceMovies > len(movies)):
+                    since = sinceMovies = 0
+
+                defocus = store.get('defocus', since).tolist()
+                dbins = array_bins([1, 2, 3], store.get('defocus'))
+                defocusAngle = store.get('defocusAngle', since).tolist()
+                astigmatism = store.get('astigmatism', since).tolist()
+                resolution = store.get('resolution', since).tolist()
+                rbins = array_bins([3, 4, 6], store.get('resolution'))
+                gridsquares = store.gridsquares(since).tolist()
+
+                if total > since:
+                    firstMic, lastMic = store.firstMic, store.lastMic
 
                 if firstMic and lastMic:
                     tsFirst, tsLast = _ts(firstMic), _ts(lastMic)
-                    step = (tsLast - tsFirst) / len(defocus)
-                else:
+                    step = (tsLast - tsFirst) / total
+                elif not since:
                     tsFirst = dt.datetime.timestamp(dt.datetime.now())
                     step = 1000
-                    tsLast = tsFirst + len(defocus) * step
+                    tsLast = tsFirst + total * step
 
-                epuData = sdata.getEpuData()
-                if epuData is None:
+                epuMovies = None if movies is None else movies[sinceMovies:]
+                if epuMovies is None:
                     beamshifts = []
                 else:
                     beamshifts = [{'x': row.beamShiftX, 'y': row.beamShiftY}
-                                  for row in epuData.moviesTable]
-                tsRange = {'first': tsFirst * 1000,  # Timestamp in milliseconds
-                           'last': tsLast * 1000,
-                           'step': step * 1000}
-                
+                                  for row in epuMovies]
+                    data['movies_count'] = sinceMovies + len(epuMovies)
+                data['micrographs_count'] = total
+                # No new micrographs since last request, the range is the same
+                if lastMic or not since:
+                    tsRange = {'first': tsFirst * 1000,  # Timestamp in milliseconds
+                               'last': tsLast * 1000,
+                               'step': step * 1000}
+
             data.update({
                 'defocus': defocus,
                 'defocusAngle': defocusAngle,
@@ -776,16 +768,191 @@ class DataContent:
                 'defocus_bins': dbins.toList(),
                 'resolution_bins': rbins.toList(),
                 'gridsquares': gridsquares,
-                'gs_info': epuData is not None,
+                'gs_info': epuMovies is not None,
+                'since': since,
+                'since_movies': sinceMovies,
+                'version': version
             })
 
         elif result == 'classes2d':
             runId = int(kwargs.get('run_id', -1))
             data['classes2d'] = sdata.get_classes2d(runId=runId)
+            if data['classes2d']:
+                self.classes2d_urls(sdata, proc['args'],
+                                    data['classes2d'].get('items', []))
 
         return data
 
 
+class BookingSerializer:
+    """ Convert bookings into calendar Event dicts.
+
+    All values that do not change between bookings of the same request
+    (bookings display config, current user and its permissions) are
+    resolved once when the serializer is created. Per-user and
+    per-application values are cached by id while serializing.
+    """
+    MISSING_RESOURCE = {
+        'name': 'Error: MISSING',
+        'status': 'inactive',
+        'tags': '',
+        'image': '',
+        'color': 'rgba(256, 256, 256, 1.0)',
+        'extra': {}
+    }
+
+    def __init__(self, dm, user):
+        self.dm = dm
+        self.user = user
+        self.display = dm.get_config('bookings')['display']
+        self.user_id = user.id
+        self.user_is_manager = user.is_manager
+        self.user_pi = user.get_pi()
+        self._missing_resource = None
+        self._pis = {}
+        self._names = {}
+        self._app_access = {}
+
+    def _get_pi(self, u):
+        if u.id not in self._pis:
+            self._pis[u.id] = u.get_pi()
+        return self._pis[u.id]
+
+    def _shortname(self, u):
+        if u.id not in self._names:
+            self._names[u.id] = shortname(u)
+        return self._names[u.id]
+
+    def allows_access(self, a):
+        """ Return True if the current user has access to application a. """
+        if a.id not in self._app_access:
+            self._app_access[a.id] = a.allows_access(self.user)
+        return self._app_access[a.id]
+
+    def _get_resource(self, booking):
+        resource = booking.resource
+        # Bookings should have resources, just in case an erroneous one
+        if resource is None:
+            if self._missing_resource is None:
+                self._missing_resource = self.dm.Resource(**self.MISSING_RESOURCE)
+            resource = self._missing_resource
+        return resource
+
+    def to_event(self, booking, **kwargs):
+        """ Return a dict that can be used as calendar Event object. """
+        resource = self._get_resource(booking)
+        owner = booking.owner
+        operator = booking.operator  # shortcut
+        a = booking.application
+        user = self.user
+        display = self.display
+        b_title = booking.title
+        b_description = booking.description
+
+        user_can_book = False
+        # Define which users are allowed to modify the booking
+        # - managers
+        # - application creators
+        # - the owner and pi of the owner
+        can_modify_list = [owner.id]
+
+        if a is not None:
+            can_modify_list.append(a.creator_id)
+
+        if self.user_is_manager and (a is None or self.allows_access(a)):
+            can_modify_list.append(self.user_id)
+
+        pi = self._get_pi(owner)
+        if pi is not None:
+            can_modify_list.append(pi.id)
+
+        user_can_modify = self.user_id in can_modify_list
+        user_can_view = user_can_modify or self.user_pi == pi
+        color = resource.color if resource else 'grey'
+
+        application_label = 'None'
+
+        if booking.type == 'special':
+            color = 'rgba(98,50,45,1.0)'
+            title = "%s (SPECIAL): %s" % (resource.name, b_title)
+        if booking.type == 'downtime':
+            color = 'rgba(181,4,0,1.0)'
+            title = "%s (DOWNTIME): %s" % (resource.name, b_title)
+        if booking.type == 'maintenance' or any(k in b_title for k in ['cycle', 'installation', 'maintenance', 'afis']):
+            color = 'rgba(255,107,53,1.0)'
+            title = "%s (MAINTENANCE): %s" % (resource.name, b_title)
+        elif booking.type == 'slot':
+            color = color.replace('1.0', '0.5')  # transparency for slots
+            title = "%s (SLOT): %s" % (resource.name,
+                                       booking.slot_auth.get('applications', ''))
+            user_can_book = user.can_book_slot(booking)
+        else:
+            # Show all booking information in title in some cases only
+            emptyApp = a is None or not display['show_application']
+            appStr = '' if emptyApp else ', %s' % a.code
+            emptyPi = (owner.is_manager or owner.is_pi or
+                       pi is None or not display.get('show_pi', False))
+            piStr = '' if emptyPi else self._shortname(pi) + '/'
+            emptyOp = operator is None or not display.get('show_operator', False)
+            opStr = '' if emptyOp else ' -> ' + self._shortname(operator)
+
+            extra = "%s%s%s%s" % (piStr, self._shortname(owner), appStr, opStr)
+            if user_can_view:
+                title = "%s (%s) %s" % (resource.name, extra, b_title)
+                if a:
+                    application_label = a.code
+                    if a.alias:
+                        application_label += "  (%s)" % a.alias
+            else:
+                title = "%s (%s)" % (resource.name, extra)
+                b_title = "Hidden title"
+                b_description = "Hidden description"
+
+        bd = {
+            'id': booking.id,
+            'title': title,
+            'resource': {'id': resource.id},
+            'start': datetime_to_isoformat(booking.start),
+            'end': datetime_to_isoformat(booking.end),
+            'color': color,
+            'textColor': 'white',
+            'booking_title': b_title,
+        }
+
+        if kwargs.get('prettyDate', False):
+            bd['pretty_start'] = pretty_datetime(booking.start)
+            bd['pretty_end'] = pretty_datetime(booking.end)
+
+        if kwargs.get('piApp', False):
+            if pi is not None:
+                bd['pi_id'] = pi.id
+                bd['pi_name'] = pi.name
+
+            if a is not None:
+                bd['app_id'] = a.id
+
+        return bd
+
+    def serialize(self, bookings, **kwargs):
+        """ Convert a list of bookings in a single pass.
+
+        Args:
+            bookings: iterable of bookings, ideally loaded with
+                eager relations (see DataManager.get_bookings(eager=True)).
+            kwargs: same options as `to_event`. Additionally, 'extra'
+                can be a function (booking) -> dict with values
+                to be added to each event.
+        """
+        extra = kwargs.pop('extra', None)
+        events = []
+        for b in bookings:
+            e = self.to_event(b, **kwargs)
+            if extra is not None:
+                e.update(extra(b))
+            events.append(e)
+        return events
+
+
 def register_content(dc):
 
     @dc.content
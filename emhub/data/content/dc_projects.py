@@ -30,6 +30,8 @@ Register content functions related to Sessions
 """
 import os
 
+import flask
+
 
 def register_content(dc):
 
@@ -203,20 +205,22 @@ def register_content(dc):
 
         images = []
 
-        # Convert images in data form to base64
-        base64 = image.Base64Converter(max_size=(512, 512))
+        # Images are loaded from the (cached) thumbnails URL
+        def _image_url(filename):
+            fn = dm.get_entry_path(entry, filename)
+            version = int(os.path.getmtime(fn)) if os.path.exists(fn) else 0
+            return flask.url_for('images.entry_image', entry_id=entry.id,
+                                 filename=filename, v=version)
 
         for k, v in data.items():
             if k.endswith('_image') and v.strip():
-                fn = dm.get_entry_path(entry, v)
-                data[k] = 'data:image/%s;base64, ' + base64.from_path(fn)
+                data[k] = _image_url(v)
 
         for k, v in data.items():
             if k.endswith('_images') or k.endswith('images_table'):
                 for row in v:
                     if 'image_file' in row:
-                        fn = dm.get_entry_path(entry, row['image_file'])
-                        row['image_data'] = 'data:image/%s;base64, ' + base64.from_path(fn)
+                        row['image_data'] = _image_url(row['image_file'])
                         images.append(row)
 
         # Group data rows by gridboxes (label)
@@ -43,16 +43,14 @@ def register_content(dc):
     @dc.content
     def reports_time_distribution(**kwargs):
 
-        def _booking_to_json(booking, **kwargs):
-            bj = dc.booking_to_event(booking, **kwargs)
-            bj.update({
+        def _booking_extra(booking):
+            return {
                 'total_cost': booking.total_cost,
                 'days': booking.days,
                 'type': booking.type
-            })
-            return bj
+            }
 
-        bookings, range_dict = dc.get_booking_in_range(kwargs, bookingFunc=_booking_to_json)
+        bookings, range_dict = dc.get_booking_in_range(kwargs, extra=_booking_extra)
 
         from emhub.reports import get_booking_counters
         counters, cem_counters = get_booking_counters(bookings)
@@ -221,7 +219,7 @@ def register_content(dc):
 
         entries = []
 
-        for b in dm.get_bookings():
+        for b in dm.get_bookings(eager=True):
             if _filter(b):
                 entries.append({'id': b.id,
                                 'title': dc.booking_to_event(b)['title'],
@@ -272,13 +270,11 @@ def register_content(dc):
     @dc.content
     def invoices_lab_list(**kwargs):
 
-        def _booking(b, **kwargs):
-            bjson = dc.booking_to_event(b, **kwargs)
-            bjson['total_cost'] = b.total_cost
-            return bjson
+        def _booking_extra(b):
+            return {'total_cost': b.total_cost}
 
         period = dc.get_period(kwargs)
-        bookings, range_dict = dc.get_booking_in_range(kwargs, bookingFunc=_booking)
+        bookings, range_dict = dc.get_booking_in_range(kwargs, extra=_booking_extra)
 
         pi_user = dc.get_pi_user(kwargs)
 
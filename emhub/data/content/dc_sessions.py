@@ -35,6 +35,8 @@ import datetime as dt
 from emtools.utils import Pretty, Path
 from emtools.metadata import Bins, TsBins, EPU
 
+from emhub.data.processing.cache import folder_timestamps
+
 
 def register_content(dc):
 
@@ -107,26 +109,25 @@ def register_content(dc):
     def session_hourly_plots(**kwargs):
         session_id = kwargs['session_id']
         plot = kwargs['plot']
-        session = dc.app.dm.load_session(session_id)
+        session = dc.app.dm.get_session_by(id=session_id)
         data = {'plot_data': [],
                 'plot_key': plot
                 }
 
         if os.path.exists(session.data_path):
+            sdata = dc.app.dm.get_processing_project(session_id=session_id)['project']
             if plot == 'imported':
-                epuData = session.data.getEpuData()
-                items = [{'ts': row.timeStamp} for row in epuData.moviesTable]
+                epuData = sdata.getEpuData()
+                timestamps = [row.timeStamp for row in epuData.moviesTable] if epuData else []
             elif plot == 'aligned':
-                sdata = session.data
-                items = []
-                for mic in sdata.get_micrographs():
-                    micFn = sdata.join(mic['micrograph'])
-                    items.append({'ts': os.path.getmtime(micFn)})
-                items.sort(key=lambda item: item['ts'])
+                # Micrographs mtimes from a listing of their folders
+                timestamps = folder_timestamps.get(sdata.join('')).get(
+                    mic['micrograph'] for mic in sdata.get_micrographs())
             else:
                 raise Exception('Unknown plot type: ' + plot)
 
-            data['plot_data'] = TsBins(items).bins
+            if timestamps:
+                data['plot_data'] = TsBins([{'ts': ts} for ts in timestamps]).bins
 
         return data
 
@@ -141,24 +142,26 @@ def register_content(dc):
 
     @dc.content
     def session_gridsquares(**kwargs):
-        session = dc.app.dm.load_session(kwargs['session_id'])
-        return {'gridsquares': session.data.get_gridsquares()}
+        sdata = dc.app.dm.get_processing_project(session_id=kwargs['session_id'])['project']
+        return {'gridsquares': sdata.get_gridsquares()}
 
     @dc.content
     def sessions_list(**kwargs):
         show_extra = 'extra' in kwargs and dc.app.user.is_admin
         dm = dc.app.dm  # shortcut
-        all_sessions = dm.get_sessions()
+        all_sessions = dm.get_sessions(eager=True)
         sessions = []
         bookingDict = {}
 
+        serializer = dc.get_booking_serializer()
+
         for s in all_sessions:
             if s.booking:
                 a = s.booking.application
-                if a is None or a.allows_access(dc.app.user):
+                if a is None or serializer.allows_access(a):
                     sessions.append(s)
-                    b = dc.booking_to_event(s.booking,
-                                              prettyDate=True, piApp=True)
+                    b = serializer.to_event(s.booking,
+                                            prettyDate=True, piApp=True)
                     bookingDict[s.booking.id] = b
 
         return {
@@ -0,0 +1,82 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+
+def _userjson(u):
+    return {'id': u.id, 'name': u.name}
+
+
+class LabDirectory:
+    """ Plain-dict snapshot of the labs, facility staff and managers.
+
+    Building the directory requires loading all users with their lab
+    members and applications, so it is done once and shared by all
+    requests of the process (see DataManager.get_lab_directory). The
+    directory is rebuilt when its version changes, that happens when
+    users, applications or resources are created, updated or deleted.
+    """
+    def __init__(self, dm, version=0):
+        self.version = version
+        self.labs = {}  # pi_id -> [pi, lab_member1, lab_member2...]
+        self.active_pis = []  # ids of active PIs
+        self.managers = []
+        self.staff = []  # list of members per staff unit (head first)
+        self.app_pis = {}  # application creator id -> pis ids
+
+        users = dm.get_users()
+        for u in users:
+            if u.is_pi:
+                self.labs[u.id] = [_userjson(u)] + [_userjson(m) for m in u.get_lab_members()]
+                if u.is_active:
+                    self.active_pis.append(u.id)
+            if 'manager' in u.roles:
+                self.managers.append(_userjson(u))
+
+        for unit in dm.get_staff_units():
+            unit_members = []
+            for u in users:
+                if u.is_staff(unit):
+                    if 'head' in u.roles:
+                        unit_members.insert(0, _userjson(u))
+                    else:
+                        unit_members.append(_userjson(u))
+            if unit_members:
+                self.staff.append(unit_members)
+
+        for a in dm.get_applications():
+            if a.is_active:
+                pis = self.app_pis.setdefault(a.creator_id, [])
+                for pi in a.users:
+                    if pi.id not in pis:
+                        pis.append(pi.id)
+
+    def get_labs(self, piIds):
+        """ Return the labs (list of users json) of the given PIs. """
+        return [list(self.labs[piId]) for piId in piIds if piId in self.labs]
+
+    def get_staff(self):
+        """ Return members grouped by staff units. """
+        return [list(members) for members in self.staff]
@@ -33,11 +33,13 @@ import json
 from collections import defaultdict
 
 import sqlalchemy
+from sqlalchemy.orm import selectinload
 from emtools.utils import Pretty
 
 from emhub.utils import datetime_from_isoformat, datetime_to_isoformat
 from .data_db import DbManager
 from .data_log import DataLog
+from .data_directory import LabDirectory
 from .data_models import create_data_models
 from .processing import get_processing_project
 
@@ -68,6 +70,8 @@ class DataManager(DbManager):
             os.makedirs(self._sessionsPath, exist_ok=True)
 
         self.r = redis
+        self._labDirectory = None
+        self._labDirectoryVersion = 0
 
     def _create_models(self):
         """ Function called from the init_db method. """
@@ -199,6 +203,36 @@ class DataManager(DbManager):
         user_groups = self.get_config('sessions')['groups']
         return user_groups.get(pi.email, 'No-group')
 
+    # ------------------------- LAB DIRECTORY --------------------------------
+    DIRECTORY_MODELS = ['User', 'Application', 'Resource', 'Form']
+    DIRECTORY_VERSION_KEY = 'directory:version'
+
+    def get_lab_directory(self):
+        """ Return the LabDirectory, it will be rebuilt only if users,
+        applications, resources or forms (e.g. staff units in config)
+        have changed since it was created.
+        When Redis is available, the version is shared between processes.
+        """
+        version = self.__lab_directory_version()
+        if self._labDirectory is None or self._labDirectory.version != version:
+            self._labDirectory = LabDirectory(self, version=version)
+        return self._labDirectory
+
+    def invalidate_lab_directory(self):
+        """ Mark the LabDirectory as outdated (in all processes). """
+        self._labDirectoryVersion += 1
+        if self.r is not None:
+            self.r.incr(self.DIRECTORY_VERSION_KEY)
+
+    def __lab_directory_version(self):
+        if self.r is not None:
+            return int(self.r.get(self.DIRECTORY_VERSION_KEY) or 0)
+        return self._labDirectoryVersion
+
+    def __check_directory(self, ModelClass):
+        if ModelClass.__name__ in self.DIRECTORY_MODELS:
+            self.invalidate_lab_directory()
+
     # ---------------------------- FORMS ---------------------------------
     def create_form(self, **attrs):
         return self.__create_item(self.Form, **attrs)
@@ -468,13 +502,22 @@ class DataManager(DbManager):
         """ Return a single Application or None. """
         return self.__item_by(self.Booking, **kwargs)
 
-    def get_bookings(self, condition=None, orderBy=None, asJson=False):
+    def get_bookings(self, condition=None, orderBy=None, asJson=False,
+                     eager=False):
+        """ Return bookings matching the condition.
+
+        If eager is True, the relations needed to serialize the bookings
+        (resource, owner, operator, creator and application) are loaded
+        in a few batch queries instead of one query per booking.
+        """
+        options = self.__booking_load_options() if eager else None
         return self.__items_from_query(self.Booking,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       options=options)
 
-    def get_bookings_range(self, start, end, resource=None):
+    def get_bookings_range(self, start, end, resource=None, eager=False):
         """ Shortcut function to retrieve a range of bookings. """
         # JMRT: We need to convert the start and end to UTC before getting the range
         newStart = self.date(start.date()).astimezone(dt.timezone.utc)
@@ -494,7 +537,8 @@ class DataManager(DbManager):
                     (e >= newStart and e <= newEnd) or
                     (s <= newStart and e >= newEnd))
 
-        bookings = [b for b in self.get_bookings(condition=conditionStr, orderBy='start')
+        bookings = [b for b in self.get_bookings(condition=conditionStr,
+                                                 orderBy='start', eager=eager)
                     if in_range(b)]
 
         return bookings
@@ -637,14 +681,22 @@ class DataManager(DbManager):
             'name': '%s%s%05d' % (code, sep, c)
         }
 
-    def get_sessions(self, condition=None, orderBy=None, asJson=False):
+    def get_sessions(self, condition=None, orderBy=None, asJson=False,
+                     eager=False):
         """ Returns a list.
         condition example: text("id<:value and name=:name")
+        If eager is True, the session's booking (and its relations)
+        will be loaded together with the sessions.
         """
+        options = None
+        if eager:
+            options = [selectinload(self.Session.booking).options(
+                *self.__booking_load_options())]
         return self.__items_from_query(self.Session,
                                        condition=condition,
                                        orderBy=orderBy,
-                                       asJson=asJson)
+                                       asJson=asJson,
+                                       options=options)
 
     def get_session_by(self, **kwargs):
         """ This should return a single Session or None. """
@@ -1126,14 +1178,19 @@ class DataManager(DbManager):
 
         self._db_session.add(new_item)
         self.commit()
+        self.__check_directory(ModelClass)
         self.log('operation', 'create_%s' % ModelClass.__name__, attrs=jsonArgs)
 
         return new_item
 
     def __items_from_query(self, ModelClass,
-                           condition=None, orderBy=None, asJson=False):
+                           condition=None, orderBy=None, asJson=False,
+                           options=None):
         query = self._db_session.query(ModelClass)
 
+        if options:
+            query = query.options(*options)
+
         if condition is not None:
             query = query.filter(sqlalchemy.text(condition))
 
@@ -1143,6 +1200,18 @@ class DataManager(DbManager):
         result = query.all()
         return [s.json() for s in result] if asJson else result
 
+    def __booking_load_options(self):
+        """ Loader options to fetch bookings with the relations used
+        when converting them to events. """
+        Booking, User = self.Booking, self.User
+        return [
+            selectinload(Booking.resource),
+            selectinload(Booking.owner).selectinload(User.pi),
+            selectinload(Booking.operator),
+            selectinload(Booking.creator),
+            selectinload(Booking.application)
+        ]
+
     def __item_by(self, ModelClass, **kwargs):
         query = self._db_session.query(ModelClass)
         return query.filter_by(**kwargs).one_or_none()
@@ -1176,6 +1245,7 @@ class DataManager(DbManager):
 
             setattr(item, attr, value)
         self.commit()
+        self.__check_directory(ModelClass)
 
         if log_operation:
             self.log('operation', 'update_%s' % ModelClass.__name__, attrs=jsonArgs)
@@ -1186,6 +1256,7 @@ class DataManager(DbManager):
         """ Remove an item from a Db model table. """
         item = self.__item_by(ModelClass, id=kwargs['id'])
         self.delete(item)
+        self.__check_directory(ModelClass)
 
         self.log("operation", "delete_%s" % ModelClass.__name__,
                  attrs=self.json_from_dict(kwargs))
@@ -15,18 +15,31 @@
 # **************************************************************************
 
 import os
+import threading
+from collections import OrderedDict
 
 from .processing_relion import RelionSessionData
 from .processing_scipion import ScipionSessionData
 
 
-def get_processing_project(project_path):
-    """ Create a Processing Project instance from this path. """
-    if not project_path or project_path.endswith('h5'):
-        return None
-    elif not os.path.exists(project_path):
-        raise Exception(f"ERROR: can't load session data path: {project_path}")
+# Recently used projects, see get_processing_project
+_projects = OrderedDict()
+_projectsLock = threading.Lock()
+MAX_PROJECTS = 16
+
 
+def _project_signature(project_path):
+    """ Modification time of the project DB (Scipion) or pipeline (Relion).
+    If none of them exists, the folder mtime is used. """
+    for fn in ['project.sqlite', 'default_pipeline.star']:
+        path = os.path.join(project_path, fn)
+        if os.path.exists(path):
+            st = os.stat(path)
+            return fn, st.st_mtime_ns, st.st_size
+    return None, os.stat(project_path).st_mtime_ns, 0
+
+
+def _create_processing_project(project_path):
     projectSqlite = os.path.join(project_path, 'project.sqlite')
 
     if os.path.exists(projectSqlite):
@@ -34,3 +47,38 @@ def get_processing_project(project_path):
 
     # TODO: check if it is a Relion project
     return RelionSessionData(project_path)
+
+
+def get_processing_project(project_path, use_cache=True):
+    """ Create a Processing Project instance from this path.
+
+    Instances are kept in a small LRU cache (shared in this process),
+    so the data loaded by them survives between requests. A project
+    is created again when its DB or pipeline file changes.
+    """
+    if not project_path or project_path.endswith('h5'):
+        return None
+    elif not os.path.exists(project_path):
+        raise Exception(f"ERROR: can't load session data path: {project_path}")
+
+    if not use_cache:
+        return _create_processing_project(project_path)
+
+    key = os.path.abspath(project_path)
+    signature = _project_signature(project_path)
+
+    with _projectsLock:
+        entry = _projects.get(key, None)
+        if entry is not None and entry[0] == signature:
+            _projects.move_to_end(key)
+            return entry[1]
+
+    project = _create_processing_project(project_path)
+
+    with _projectsLock:
+        _projects[key] = (signature, project)
+        _projects.move_to_end(key)
+        while len(_projects) > MAX_PROJECTS:
+            _projects.popitem(last=False)
+
+    return project
@@ -25,6 +25,10 @@ from emtools.utils import Path, Timer, Pretty
 from emtools.metadata import StarFile, EPU, SqliteFile
 from emtools.image import Thumbnail
 
+from .cache import star_cache, star_tails
+from .ctf_store import get_gridsquare_index
+from .summary import SessionSummary
+
 
 def hours(tsFirst, tsLast):
     dtFirst = dt.datetime.fromtimestamp(tsFirst)
@@ -63,18 +67,27 @@ class SessionData:
     """ Base class with common functionality. """
     def __init__(self, path, mode='r'):
         self._path = path
-        self._epuData = None
 
     def join(self, *paths):
         return os.path.join(self._path, *paths)
 
     def getEpuData(self):
-        if not self._epuData:
-            epuFolder = self.join('EPU')
-            moviesStarFile = self.join('EPU', 'movies.star')
-            if Path.exists(moviesStarFile):
-                self._epuData = EPU.Data(epuFolder, moviesStarFile)
-        return self._epuData
+        """ Return the EPU data, the star_cache keeps it (it is not stored
+        in this instance since projects are also cached between requests). """
+        epuFolder = self.join('EPU')
+        moviesStarFile = self.join('EPU', 'movies.star')
+        if Path.exists(moviesStarFile):
+            return star_cache.get(moviesStarFile, 'epu',
+                                  lambda p: EPU.Data(epuFolder, p))
+        return None
+
+    def get_epu_movies(self, start=0):
+        """ Return the rows of the EPU movies table from the start index,
+        or None if there is no EPU data. The file is read incrementally. """
+        moviesStarFile = self.join('EPU', 'movies.star')
+        if not os.path.exists(moviesStarFile):
+            return None
+        return star_tails.get(moviesStarFile, 'Movies').rows_since(start)
 
     def mtime(self, fn):
         mt = os.path.getmtime(self.join(fn))
@@ -84,11 +97,35 @@ class SessionData:
         """ Deprecated, just for backward compatibility. """
         pass
 
-    # ------------ Functions to override in subclasses ---------------------
+    def get_summary(self):
+        """ Return the summary written by the indexer task, or None if it
+        does not exist or it is not up to date (see SessionSummary). """
+        return SessionSummary(self.join('')).load()
+
     def get_stats(self):
+        """ Return the stats from the session summary if available,
+        with its version as 'summary', or from the output files. """
+        if summary := self.get_summary():
+            return dict(summary['stats'], summary=summary['version'])
+        return self.load_stats()
+
+    def get_classes2d_runs(self):
+        """ Return the 2D classification runs from the session summary
+        if available, or from the project. """
+        if summary := self.get_summary():
+            return summary['classes2d_runs']
+        return self.load_classes2d_runs()
+
+    # ------------ Functions to override in subclasses ---------------------
+    def load_stats(self):
+        """ Compute the stats from the output files. """
         return {'movies': {'count': 0}, 'ctfs': {'count': 0}}
 
-    def get_micrographs(self):
+    def load_classes2d_runs(self):
+        """ Find the 2D classification runs in the project. """
+        return []
+
+    def get_micrographs(self, start=0):
         return []
 
     def get_micrograph_data(self):
@@ -97,6 +134,10 @@ class SessionData:
     def get_micrograph_coordinates(self, micName):
         return []
 
+    def get_micrograph_particles(self, micName):
+        """ Return the number of particles picked in a micrograph. """
+        return len(self.get_micrograph_coordinates(micName))
+
     def get_micrograph_gridsquare(self, **kwargs):
         epuData = self.getEpuData()
         gsId = kwargs.get('gsId', '')
@@ -107,60 +148,36 @@ class SessionData:
         if epuData is None:
             return locData
 
-        thumb = Thumbnail(output_format='base64', max_size=(512, 512))
+        gsIndex = get_gridsquare_index(self.join(''))
+        gsIndex.update(self)
 
         for row in epuData.gsTable:
             if row.id == gsId:
-                imgPath = self.join('EPU', row.folder, row.image)
                 locData['gridSquare'] = {
                     'id': row.id,
                     'image': row.image,
                     'folder': row.folder,
-                    'thumbnail': thumb.from_path(imgPath)
+                    # Relative to the project, rendered by the images endpoints
+                    'imageFile': os.path.join('EPU', row.folder, row.image)
                 }
                 break
 
-        def _microns(v):
-            return round(v * 0.0001, 3)
-
-        defocus = []
-        resolution = []
-        particles = 0
-        for mic in self.get_micrographs():
-            micName = mic.get('micName', mic['micrograph'])
-            loc = EPU.get_movie_location(micName)
-            if loc['gs'] == gsId:
-                defocus.append(_microns(mic['ctfDefocus']))
-                resolution.append(round(mic['ctfResolution'], 3))
-                particles += len(self.get_micrograph_coordinates(micName))
-
-        locData.update({'defocus': defocus,
-                        'resolution': resolution,
-                        'particles': particles
-                        })
-
+        locData.update(gsIndex.get(self, gsId))
         return locData
 
     def get_gridsquares(self, **kwargs):
-        epuData = self.getEpuData()
-        gs = []
-        lastGs = None
-        counter = 0
-        if epuData is not None:
-            for row in epuData.moviesTable:
-                movieGs = row.gsId
-                if movieGs != lastGs:
-                    if lastGs:
-                        gs.append({'gsId': lastGs, 'micrographs': counter})
-                    lastGs = movieGs
-                    counter = 0
-                counter += 1
-            gs.append({'gsId': lastGs, 'count': counter})
-
-        return gs
-
-    def get_classes2d(self):
-        pass
+        """ Return the gridsquares with processed micrographs, from the
+        session summary or the GridsquareIndex of the project. """
+        if summary := self.get_summary():
+            return summary['gridsquares']
+        if self.getEpuData() is None:
+            return []
+        gsIndex = get_gridsquare_index(self.join(''))
+        gsIndex.update(self)
+        return gsIndex.gridsquares()
+
+    def get_classes2d(self, runId=None):
+        return {}
 
     def get_workflow(self):
         """ Return protocols and their relations. """
@@ -0,0 +1,340 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import time
+import threading
+from collections import OrderedDict, defaultdict
+
+from emtools.metadata import StarFile
+from emtools.metadata.table import Table, ColumnList
+
+
+class ParsedFileCache:
+    """ Keep in memory the result of parsing files (e.g. STAR tables).
+
+    Entries are keyed by the file path and a name (e.g. the table name)
+    and are valid while the file mtime and size do not change, so
+    unchanged files are not parsed again on every request. The least
+    recently used entries are removed when there are more than
+    max_entries or the total size is over max_bytes.
+
+    The size of an entry is estimated from the size of the parsed file,
+    the memory used by the parsed values is roughly proportional to it
+    (e.g. rows of a STAR table), and measuring Python objects is too
+    expensive to do on every update.
+
+    The cache is shared by all requests in the same process, so the
+    returned objects should not be modified by the callers.
+    """
+    def __init__(self, max_entries=128, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, name, loader):
+        """ Return the cached result of loader(path), calling it again
+        only if there is no entry or the file has changed.
+        """
+        st = os.stat(path)
+        signature = (st.st_mtime_ns, st.st_size)
+        key = (os.path.abspath(path), name)
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        value = loader(path)
+
+        with self._lock:
+            self.misses += 1
+            if key in self._entries:
+                self._bytes -= self._entries[key][0][1]
+            self._entries[key] = (signature, value)
+            self._entries.move_to_end(key)
+            self._bytes += st.st_size
+            # Keep at least the new entry, even if it is bigger than max_bytes
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries
+                                              or self._bytes > self.max_bytes):
+                oldSignature, _ = self._entries.popitem(last=False)[1]
+                self._bytes -= oldSignature[1]
+
+        return value
+
+    def get_table(self, path, tableName, guessType=True):
+        """ Return a table from a STAR file. """
+        def _load(p):
+            with StarFile(p) as sf:
+                return sf.getTable(tableName, guessType=guessType)
+
+        return self.get(path, ('table', tableName, guessType), _load)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = 0
+
+    def get_stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else 0,
+                'files': sorted({k[0] for k in self._entries})
+            }
+
+
+class StarTableTail:
+    """ Read incrementally a table from a STAR file that grows by
+    appending rows (e.g. micrographs_ctf.star or EPU movies.star during OTF).
+
+    The byte offset after the last complete row and the parsed rows are
+    kept, so on update only the appended lines are parsed. If the file
+    was rewritten with a different content before that offset (e.g. the
+    header or a previous table changed) or it is smaller, the table is
+    read again from the beginning. Only tables with a loop are supported.
+    """
+    def __init__(self, path, tableName, guessType=True):
+        self.path = path
+        self.tableName = tableName
+        self.guessType = guessType
+        self.resets = 0
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.rows = []
+        self._offset = None  # offset after the last parsed row
+        self._header = None  # bytes from the beginning to the first row
+        self._lastLine = b''
+        self._colNames = None
+        self._table = None
+        self._types = None
+
+    def _read_header(self, f):
+        """ Find the table columns and return the offset of the first row. """
+        dataLine = ('data_%s' % self.tableName).encode()
+        line = f.readline()
+        while line and line.strip() != dataLine:
+            line = f.readline()
+        if not line:
+            raise Exception("'%s' block was not found in %s"
+                            % (dataLine.decode(), self.path))
+
+        colNames = []
+        foundLoop = False
+        offset = f.tell()
+        while rawLine := f.readline():
+            line = rawLine.strip()
+            if line.startswith(b'loop_'):
+                foundLoop = True
+            elif line.startswith(b'_'):
+                colNames.append(line.split()[0][1:].decode())
+            elif colNames:
+                break
+            offset = f.tell()
+
+        if not foundLoop:
+            raise Exception("Table '%s' in %s is not a loop table"
+                            % (self.tableName, self.path))
+        return colNames, offset
+
+    def _is_prefix_unchanged(self, f, size):
+        if size < self._offset:
+            return False
+        f.seek(0)
+        if f.read(len(self._header)) != self._header:
+            return False
+        n = len(self._lastLine)
+        f.seek(self._offset - n)
+        return f.read(n) == self._lastLine
+
+    def update(self):
+        """ Parse the new rows, return the number of rows added. """
+        with self._lock:
+            if not os.path.exists(self.path):
+                self._reset()
+                return 0
+
+            size = os.path.getsize(self.path)
+            with open(self.path, 'rb') as f:
+                if self._offset is not None and not self._is_prefix_unchanged(f, size):
+                    self._reset()
+                    self.resets += 1
+
+                if self._offset is None:
+                    f.seek(0)
+                    colNames, self._offset = self._read_header(f)
+                    f.seek(0)
+                    self._header = f.read(self._offset)
+                    self._colNames = colNames
+                elif self._offset == size:
+                    return 0
+
+                f.seek(self._offset)
+                n = len(self.rows)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # incomplete line, still being written
+                    values = line.decode().split()
+                    if not values or values[0].startswith('data_'):
+                        break  # end of the table
+                    self._add_row(values)
+                    self._offset += len(line)
+                    self._lastLine = line
+
+                return len(self.rows) - n
+
+    def _add_row(self, values):
+        if self._table is None:
+            cols = ColumnList.createColumns(self._colNames, values,
+                                            guessType=self.guessType)
+            self._table = Table(columns=cols)
+            self._types = [c.getType() for c in cols]
+        self.rows.append(self._table.Row(*[t(v) for t, v in zip(self._types, values)]))
+
+    def rows_since(self, start=0):
+        """ Update and return the rows from the start index. """
+        self.update()
+        return self.rows[start:]
+
+
+class StarTailRegistry:
+    """ Keep the tail readers of the most recently used tables. """
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._tails = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, tableName):
+        key = (os.path.abspath(path), tableName)
+        with self._lock:
+            if key not in self._tails:
+                self._tails[key] = StarTableTail(path, tableName)
+            self._tails.move_to_end(key)
+            while len(self._tails) > self.max_entries:
+                self._tails.popitem(last=False)
+            return self._tails[key]
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._tails),
+                'rows': sum(len(t.rows) for t in self._tails.values()),
+                'resets': sum(t.resets for t in self._tails.values())
+            }
+
+
+class FolderTimestamps:
+    """ Modification time of the files in the folders of a project,
+    collected with os.scandir (one listing per folder instead of one
+    stat call per file, that is slow on network file systems).
+
+    A folder is only listed again if its mtime changed (files were added,
+    removed or renamed in it), so folders that are still growing during
+    a live session are only listed when there are new files. Only the
+    files not seen in the previous listing are stat'ed.
+    """
+    # Folder mtimes could have a coarse resolution (e.g. 1 s in some file
+    # systems), so a folder listed within that time around its last change
+    # is listed again on the next call, files could have been added
+    # without changing the mtime. The difference is absolute because the
+    # clock of the file server could be ahead of this one.
+    MTIME_RESOLUTION = 1  # seconds
+
+    def __init__(self, root):
+        self.root = root
+        self._folders = {}
+        self._lock = threading.Lock()
+        self.scans = 0
+        self.stats = 0
+
+    def _folder(self, folder):
+        path = os.path.join(self.root, folder)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return {}
+
+        entry = self._folders.get(folder, None)
+        if (entry is None or entry[0] != mtime
+                or abs(entry[1] - mtime) <= self.MTIME_RESOLUTION):
+            scanTime = time.time()
+            known = entry[2] if entry else {}
+            files = {}
+            with os.scandir(path) as it:
+                for e in it:
+                    if e.name in known:
+                        files[e.name] = known[e.name]
+                    elif e.is_file():
+                        files[e.name] = e.stat().st_mtime
+                        self.stats += 1
+            entry = self._folders[folder] = (mtime, scanTime, files)
+            self.scans += 1
+        return entry[2]
+
+    def get(self, files):
+        """ Return the sorted timestamps of the given files (relative to
+        the root), files that do not exist are ignored. """
+        byFolder = defaultdict(list)
+        for fn in files:
+            folder, name = os.path.split(fn)
+            byFolder[folder].append(name)
+
+        timestamps = []
+        with self._lock:
+            for folder, names in byFolder.items():
+                mtimes = self._folder(folder)
+                timestamps.extend(mtimes[n] for n in names if n in mtimes)
+        timestamps.sort()
+        return timestamps
+
+
+class FolderTimestampsRegistry:
+    """ Keep the FolderTimestamps of the most recently used projects. """
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, root):
+        key = os.path.abspath(root)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = FolderTimestamps(root)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return self._entries[key]
+
+
+# Caches shared by all processing projects loaded in this process
+star_cache = ParsedFileCache()
+star_tails = StarTailRegistry()
+folder_timestamps = FolderTimestampsRegistry()
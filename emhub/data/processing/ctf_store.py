@@ -0,0 +1,285 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from emtools.metadata import Bins, EPU
+
+
+def array_bins(delimiters, values):
+    """ Create Bins from an array of values (same as calling addValue
+    for each value, a value goes to the first bin with v < delimiter). """
+    bins = Bins(delimiters)
+    counts = np.bincount(np.searchsorted(delimiters, values, side='right'),
+                         minlength=len(delimiters) + 1)
+    bins.bins = counts.tolist()
+    bins.total = int(len(values))
+    return bins
+
+
+class CtfStore:
+    """ Columnar CTF values of the micrographs of a processing project.
+
+    Values are kept as NumPy arrays (defocus and astigmatism in microns)
+    and persisted in a compressed .npz file in the project folder. On
+    update, only micrographs after the stored ones are read, so the EPU
+    location of each micrograph is only parsed once. The file is also
+    updated by the indexer task of the session worker, so it is loaded
+    again when its mtime changes.
+    """
+    FILENAME = 'emhub_ctf.npz'
+    COLUMNS = ['defocus', 'defocusAngle', 'astigmatism', 'resolution', 'gsIndex']
+
+    def __init__(self, projectPath):
+        self.path = os.path.join(projectPath, self.FILENAME)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._clear()
+        self._reload()
+
+    def _reload(self):
+        """ Load the file if it was written since the last load or save. """
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            try:
+                self._load()
+            except Exception:
+                self._clear()  # corrupted or old format, rebuild it
+            self._mtime = mtime
+
+    def _clear(self):
+        self.columns = {c: np.empty(0, dtype=np.int32 if c == 'gsIndex' else np.float64)
+                        for c in self.COLUMNS}
+        self.gsNames = []
+        self.firstMic = self.lastMic = ''
+
+    def _load(self):
+        with np.load(self.path, allow_pickle=False) as npz:
+            self.columns = {c: npz[c] for c in self.COLUMNS}
+            self.gsNames = npz['gsNames'].tolist()
+            self.firstMic, self.lastMic = npz['mics'].tolist()
+
+    def _save(self):
+        """ Write the file atomically, keep only in memory if the
+        project folder is not writable. """
+        folder = os.path.dirname(self.path)
+        try:
+            fd, tmpPath = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, gsNames=np.array(self.gsNames, dtype=str),
+                                    mics=np.array([self.firstMic, self.lastMic]),
+                                    **self.columns)
+            os.replace(tmpPath, self.path)
+            self._mtime = os.path.getmtime(self.path)
+        except:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+    @property
+    def count(self):
+        return len(self.columns['defocus'])
+
+    def update(self, sdata, count, grow_only=False):
+        """ Read the micrographs added since the last update.
+
+        Args:
+            sdata: processing project (SessionData)
+            count: number of micrographs with CTF in the project, if it is
+                lower than the stored ones, or the first micrograph is not
+                the same, the store is rebuilt.
+            grow_only: if True, a lower count only means that there are no
+                new micrographs (e.g. the count is from the session summary,
+                that can be behind the files). The store is still rebuilt
+                if the first micrograph is not the same.
+        """
+        with self._lock:
+            self._reload()
+
+            if self.count:
+                first = next(iter(sdata.get_micrographs()), None)
+                if ((count < self.count and not grow_only) or first is None
+                        or first['micrograph'] != self.firstMic):
+                    self._clear()
+
+            if count == self.count or (grow_only and count < self.count):
+                return 0
+
+            gsMap = {gs: i for i, gs in enumerate(self.gsNames)}
+            new = {c: [] for c in self.COLUMNS}
+            firstMic = lastMic = None
+            for mic in sdata.get_micrographs(start=self.count):
+                lastMic = mic['micrograph']
+                firstMic = firstMic or lastMic
+                micName = mic.get('micName', lastMic)
+                gs = EPU.get_movie_location(micName)['gs']
+                if gs not in gsMap:
+                    gsMap[gs] = len(self.gsNames)
+                    self.gsNames.append(gs)
+                new['defocus'].append(mic['ctfDefocus'])
+                new['defocusAngle'].append(mic['ctfDefocusAngle'])
+                new['astigmatism'].append(mic['ctfAstigmatism'])
+                new['resolution'].append(mic['ctfResolution'])
+                new['gsIndex'].append(gsMap[gs])
+
+            if lastMic is None:
+                return 0
+
+            if not self.count:
+                self.firstMic = firstMic
+            self.lastMic = lastMic
+
+            values = {
+                'defocus': np.round(np.array(new['defocus']) * 0.0001, 3),
+                'defocusAngle': np.array(new['defocusAngle']),
+                'astigmatism': np.round(np.array(new['astigmatism']) * 0.0001, 3),
+                'resolution': np.round(np.array(new['resolution']), 3),
+                'gsIndex': np.array(new['gsIndex'])
+            }
+            for c, v in values.items():
+                self.columns[c] = np.concatenate(
+                    [self.columns[c], v.astype(self.columns[c].dtype)])
+            self._save()
+            return len(new['defocus'])
+
+    def get(self, column, start=0):
+        return self.columns[column][start:]
+
+    def gridsquares(self, start=0):
+        """ Gridsquare id of each micrograph from start. """
+        return np.array(self.gsNames, dtype=str)[self.columns['gsIndex'][start:]]
+
+
+class GridsquareIndex:
+    """ Micrographs of a processing project grouped by gridsquare.
+
+    It is built on top of the CtfStore (where the gridsquare of each
+    micrograph is already stored) and updated with the new micrographs,
+    so the values of a gridsquare are taken only from its micrographs.
+    The number of particles is counted when a gridsquare is requested
+    and kept for the micrographs that already have particles.
+    """
+    def __init__(self, projectPath):
+        self.projectPath = projectPath
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.count = 0
+        self.firstMic = ''
+        self.gsMics = OrderedDict()  # gridsquare -> micrograph indexes
+        self.micNames = []
+        self.particles = {}
+
+    @property
+    def store(self):
+        return get_ctf_store(self.projectPath)
+
+    def update(self, sdata, count=None):
+        """ Add the new micrographs of the project (sdata) to the index.
+        count is the number of micrographs with CTF, taken from the
+        project stats if not given. """
+        store = self.store
+        if count is None:
+            stats = sdata.get_stats()
+            store.update(sdata, stats['ctfs']['count'], grow_only='summary' in stats)
+        else:
+            store.update(sdata, count)
+
+        with self._lock:
+            if store.count < self.count or store.firstMic != self.firstMic:
+                self._clear()
+                self.firstMic = store.firstMic
+
+            n = store.count - self.count
+            if n <= 0:
+                return
+
+            for mic in sdata.get_micrographs(start=self.count):
+                self.micNames.append(mic.get('micName', mic['micrograph']))
+                if len(self.micNames) == store.count:
+                    break
+
+            gsIndex = store.get('gsIndex', self.count)[:len(self.micNames) - self.count]
+            for i, g in enumerate(gsIndex.tolist(), start=self.count):
+                self.gsMics.setdefault(store.gsNames[g], []).append(i)
+            self.count = len(self.micNames)
+
+    def gridsquares(self):
+        """ Return the gridsquares (in acquisition order) and
+        their number of micrographs. """
+        return [{'gsId': gs, 'micrographs': len(mics)}
+                for gs, mics in self.gsMics.items()]
+
+    def get(self, sdata, gsId):
+        """ Return the micrograph ids (starting at 1), defocus, resolution
+        and number of particles of the micrographs in a gridsquare. """
+        mics = np.array(self.gsMics.get(gsId, []), dtype=np.int64)
+        store = self.store
+        particles = 0
+        for i in mics.tolist():
+            if (n := self.particles.get(i, 0)) == 0:
+                n = sdata.get_micrograph_particles(self.micNames[i])
+                if n:  # not picked micrographs could have particles later
+                    self.particles[i] = n
+            particles += n
+
+        return {
+            'micIds': (mics + 1).tolist(),
+            'defocus': store.get('defocus')[mics].tolist(),
+            'resolution': store.get('resolution')[mics].tolist(),
+            'particles': particles
+        }
+
+
+_stores = OrderedDict()
+_storesLock = threading.Lock()
+
+
+def _get_cached(registry, key, create, max_entries):
+    with _storesLock:
+        if key not in registry:
+            registry[key] = create()
+        registry.move_to_end(key)
+        while len(registry) > max_entries:
+            registry.popitem(last=False)
+        return registry[key]
+
+
+def get_ctf_store(projectPath, max_entries=32):
+    """ Return the CtfStore of a project, kept in memory between requests. """
+    key = os.path.abspath(projectPath)
+    return _get_cached(_stores, key, lambda: CtfStore(projectPath), max_entries)
+
+
+_gsIndexes = OrderedDict()
+
+
+def get_gridsquare_index(projectPath, max_entries=32):
+    """ Return the GridsquareIndex of a project, kept in memory between requests. """
+    key = os.path.abspath(projectPath)
+    return _get_cached(_gsIndexes, key, lambda: GridsquareIndex(projectPath),
+                       max_entries)
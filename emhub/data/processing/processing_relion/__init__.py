@@ -16,87 +16,279 @@
 
 import os
 import datetime as dt
+import threading
 from glob import glob
+from fnmatch import fnmatch
 from collections import defaultdict
 import json
+from concurrent.futures import ThreadPoolExecutor
 import flask
 import numpy as np
 from flask import current_app as app
 
 import mrcfile
 from emtools.utils import Path, Timer, Pretty
-from emtools.metadata import StarFile, EPU, SqliteFile
+from emtools.metadata import StarFile, EPU, SqliteFile, Table
 from emtools.image import Thumbnail
 
+from emhub.utils.image import (thumbnail_scale, volume_info, THUMBNAIL_KINDS,
+                               ThumbnailCache, load_ctf_profile, ctf_profile_path)
 from ..base import SessionRun, SessionData, hours
+from ..cache import star_cache, star_tails
 
 location = os.path.dirname(__file__)
 
 
+def get_classes2d_items(runFolder, projectPath, iteration=None):
+    """ Get the 2D classes from the Relion output files in runFolder
+    (of the given iteration or the last one). Averages are referenced by
+    the stack file (relative to projectPath) and the index in the stack,
+    so they can be rendered by the images endpoints.
+    """
+    items = []
+
+    if iteration:
+        avgMrcs = os.path.join(runFolder, '*_it%03d_classes.mrcs' % int(iteration))
+    else:
+        avgMrcs = os.path.join(runFolder, '*_it*_classes.mrcs')
+
+    if files := glob(avgMrcs):
+        files.sort()
+        avgMrcs = files[-1]
+        dataStar = avgMrcs.replace('_classes.mrcs', '_data.star')
+        modelStar = dataStar.replace('_data.', '_model.')
+
+        avgFile = os.path.relpath(avgMrcs, projectPath)
+
+        with StarFile(dataStar) as sf:
+            n = sf.getTableSize('particles')
+
+        with StarFile(modelStar) as sf:
+            modelTable = sf.getTable('model_classes', guessType=False)
+
+            for row in modelTable:
+                i, fn = row.rlnReferenceImage.split('@')
+                items.append({
+                    'id': '%03d' % int(i),
+                    'size': round(float(row.rlnClassDistribution) * n),
+                    'file': avgFile,
+                    'index': int(i) - 1
+                })
+        items.sort(key=lambda c: c['size'], reverse=True)
+
+    return items
+
+
+class FormRegistry:
+    """ Form definitions of Relion jobs, read from the JSON files in the
+    forms folder (named <package>.<className>.json).
+
+    Each file is loaded and validated only the first time it is requested,
+    with the defaults already set in its params. The returned forms are
+    shared by all runs, so they should not be modified.
+    """
+    DEFAULT = {'valueClass': 'String',
+               'paramClass': 'StringParam',
+               'important': False,
+               'expert': False
+               }
+
+    def __init__(self, formsPath):
+        self.formsPath = formsPath
+        self._forms = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def set_defaults(cls, paramDef):
+        for k, v in cls.DEFAULT.items():
+            if k not in paramDef:
+                paramDef[k] = v
+        return paramDef
+
+    def _load(self, configFn):
+        form = {'sections': [], 'params': frozenset()}
+        if not os.path.exists(configFn):
+            return form
+
+        with open(configFn) as f:
+            formConf = json.load(f)
+
+        sections = formConf.get('sections', None)
+        if not isinstance(sections, list):
+            raise Exception("Invalid form %s, expecting a list of 'sections'" % configFn)
+
+        params = set()
+        for sectionDef in sections:
+            if not isinstance(sectionDef.get('params', None), list):
+                raise Exception("Invalid form %s, section '%s' without 'params'"
+                                % (configFn, sectionDef.get('label', '')))
+            for paramDef in sectionDef['params']:
+                if 'name' in paramDef:
+                    self.set_defaults(paramDef)
+                    params.add(paramDef['name'])
+
+        form['sections'] = sections
+        form['params'] = frozenset(params)
+        return form
+
+    def get(self, package, className):
+        """ Return a dict with the 'sections' of the form and the
+        names of its 'params'. """
+        key = f"{package}.{className}"
+        with self._lock:
+            if key not in self._forms:
+                self._forms[key] = self._load(
+                    os.path.join(self.formsPath, key + '.json'))
+            return self._forms[key]
+
+
+relion_forms = FormRegistry(os.path.join(location, 'forms'))
+
+
+class PipelineIndex:
+    """ Jobs of a Relion project parsed from its default_pipeline.star.
+
+    Processes are kept by name (e.g. 'CtfFind/job004/') with their alias,
+    type and status, grouped by job type (the folder) in job number order,
+    together with the input and output nodes of each process. Instances
+    are cached in star_cache, so the pipeline is only parsed again when
+    it changes (see RelionSessionData.pipeline).
+    """
+    STATUS_MAP = {
+        'Succeeded': 'finished',
+        'Running': 'running',
+        'Aborted': 'aborted',
+        'Failed': 'failed'
+    }
+
+    def __init__(self, pipelineStar):
+        self.processes = {}
+        self.jobs = defaultdict(list)
+        self.inputs = defaultdict(list)
+        self.outputs = defaultdict(list)
+        self.links = defaultdict(list)  # process -> processes using its outputs
+
+        with StarFile(pipelineStar) as sf:
+            for row in sf.iterTable('pipeline_processes', guessType=False):
+                name = row.rlnPipeLineProcessName
+                alias = row.rlnPipeLineProcessAlias
+                self.processes[name] = {
+                    'name': name,
+                    'alias': alias,
+                    'label': alias if alias != 'None' else name,
+                    'type': getattr(row, 'rlnPipeLineProcessTypeLabel', ''),
+                    'status': self.STATUS_MAP.get(
+                        getattr(row, 'rlnPipeLineProcessStatusLabel', ''), 'unknown')
+                }
+                self.jobs[name.split('/')[0]].append(name)
+
+            if 'pipeline_output_edges' in sf:
+                for row in sf.iterTable('pipeline_output_edges', guessType=False):
+                    self.outputs[row.rlnPipeLineEdgeProcess].append(
+                        row.rlnPipeLineEdgeToNode)
+
+            if 'pipeline_input_edges' in sf:
+                for row in sf.iterTable('pipeline_input_edges', guessType=False):
+                    self.inputs[row.rlnPipeLineEdgeProcess].append(
+                        row.rlnPipeLineEdgeFromNode)
+
+        producers = {node: proc for proc, nodes in self.outputs.items()
+                     for node in nodes}
+        for child, nodes in self.inputs.items():
+            for node in nodes:
+                parent = producers.get(node, None)
+                if parent in self.processes and child not in self.links[parent]:
+                    self.links[parent].append(child)
+
+        for names in self.jobs.values():
+            names.sort(key=self.job_number)
+
+    @staticmethod
+    def job_number(name):
+        return int(name.rstrip('/').split('/job')[1])
+
+    def get_process(self, name):
+        return self.processes.get(Path.rmslash(name) + '/', None)
+
+    def get_jobs(self, jobType):
+        """ Names of the processes of this type (it can be a pattern
+        like '*Pick'), sorted by job number. """
+        if any(c in jobType for c in '*?['):
+            names = [n for t, tNames in self.jobs.items()
+                     if fnmatch(t, jobType) for n in tNames]
+            names.sort(key=self.job_number)
+            return names
+        return self.jobs.get(jobType, [])
+
+    def get_links(self, name):
+        """ Processes that use some output of this process as input. """
+        return list(self.links.get(name, []))
+
+
 class RelionRun(SessionRun):
     """ Helper class to manipulate Relion run data. """
     def __init__(self, project, path):
         SessionRun.__init__(self, project, path)
         d, self.id = os.path.split(Path.rmslash(path))
-        with StarFile(self.join('job.star')) as sf:
-            self.job = sf.getTable('job')
-            self.values = {row.rlnJobOptionVariable: row.rlnJobOptionValue
-                           for row in sf.iterTable('joboptions_values', guessType=False)}
-        parts = self.job[0].rlnJobTypeLabel.split('.')
+        jobName = os.path.relpath(path, project.join(''))
+        pipeline = project.pipeline()
+        self.process = pipeline.get_process(jobName) if pipeline else None
+
+        if self.process is None:
+            with StarFile(self.join('job_pipeline.star')) as sf:
+                row = sf.getTable('pipeline_processes', guessType=False)[0]
+                self.process = {'name': row.rlnPipeLineProcessName,
+                                'alias': row.rlnPipeLineProcessAlias,
+                                'type': getattr(row, 'rlnPipeLineProcessTypeLabel', '')}
+            self._pipeline = None
+        else:
+            self._pipeline = pipeline
+
+        self.name = self.process['name']
+        self.alias = self.process['alias']
+        jobType = self.process['type']
+        if not jobType or jobType.isdigit():  # old pipelines only have the type number
+            jobType = self._job_star()[0][0].rlnJobTypeLabel
+        parts = jobType.split('.')
         self.package = parts[0]
         self.className = parts[1]
         self.classSuffix = '' if len(parts) < 3 else '.'.join(parts[2:])
 
-        with StarFile(self.join('job_pipeline.star')) as sf:
-            t = sf.getTable('pipeline_processes')
-            row = t[0]
-            self.name = row.rlnPipeLineProcessName
-            self.alias = row.rlnPipeLineProcessAlias
+    def _job_star(self):
+        """ Return the job table and the job options from job.star,
+        only read when needed and cached until the file changes. """
+        def _load(fn):
+            with StarFile(fn) as sf:
+                job = sf.getTable('job')
+                values = {row.rlnJobOptionVariable: row.rlnJobOptionValue
+                          for row in sf.iterTable('joboptions_values', guessType=False)}
+            return job, values
+
+        return star_cache.get(self.join('job.star'), 'job', _load)
+
+    @property
+    def job(self):
+        return self._job_star()[0]
+
+    @property
+    def values(self):
+        return self._job_star()[1]
 
     def getInfo(self):
         return {'id': self.id, 'className': self.className, 'label': self.id,
                 'name': self.name, 'alias': self.alias}
 
     def getFormDefinition(self):
-        default = {'valueClass': 'String',
-                   'paramClass': 'StringParam',
-                   'important': False,
-                   'expert': False
-                   }
-
+        form = relion_forms.get(self.package, self.className)
         formDef = {
             'package': 'relion',
             'name': self.className,
             'logo': '',
-            'sections': []
+            'sections': list(form['sections'])
         }
 
-        allParams = set()
-
-        def _set_defaults(paramDef):
-            for k, v in default.items():
-                if k not in paramDef:
-                    paramDef[k] = v
-            return paramDef
-
-        config = f"{self.package}.{self.className}.json"
-        configFn = os.path.join(location, 'forms', config)
-        print("Config file", configFn)
-
-        if os.path.exists(configFn):
-            with open(configFn) as f:
-                formConf = json.load(f)
-                for sectionDef in formConf['sections']:
-                    for paramDef in sectionDef['params']:
-                        if 'name' in paramDef:
-                            _set_defaults(paramDef)
-                            allParams.add(paramDef['name'])
-                    formDef['sections'].append(sectionDef)
-
-        extraParams = []
-        for k, v in self.values.items():
-            if k not in allParams:
-                extraParams.append(_set_defaults({'label': k, 'name': k}))
+        extraParams = [relion_forms.set_defaults({'label': k, 'name': k})
+                       for k in self.values if k not in form['params']]
 
         if extraParams:
             formDef['sections'].append({'label': 'extra params',
@@ -116,6 +308,12 @@ class RelionRun(SessionRun):
         return self.join('run.err')
 
     def getInputsOutputs(self):
+        if self._pipeline is not None:
+            return {
+                'inputs': list(self._pipeline.inputs.get(self.name, [])),
+                'outputs': list(self._pipeline.outputs.get(self.name, []))
+            }
+
         with StarFile(self.join('job_pipeline.star')) as sf:
             inputsTable = sf.getTable('pipeline_input_edges')
             outputsTable = sf.getTable('pipeline_output_edges')
@@ -153,13 +351,13 @@ class RelionRun(SessionRun):
             }
         }
         indexes = []
-        with StarFile(self.join('micrographs_ctf.star')) as sf:
-            for i, row in enumerate(sf.iterTable('micrographs')):
-                indexes.append(i + 1)
-                rowDict = row._asdict()
-                for k, v in data_values.items():
-                    scale = v.get('scale', 1)
-                    v['data'].append(rowDict[k] * scale)
+        table = star_cache.get_table(self.join('micrographs_ctf.star'), 'micrographs')
+        for i, row in enumerate(table):
+            indexes.append(i + 1)
+            rowDict = row._asdict()
+            for k, v in data_values.items():
+                scale = v.get('scale', 1)
+                v['data'].append(rowDict[k] * scale)
         if index:
             data_values['index'] = {
                 'label': 'Index',
@@ -189,19 +387,11 @@ class RelionRun(SessionRun):
                     'data': []
                 }
             }
-            # TODO: Write this info in a star file to avoid recalculating all the time
             pts = data_values['numberOfParticles']['data']
             fom = data_values['averageFOM']['data']
-            with StarFile(self.join('autopick.star')) as sfCoords:
-                for row1 in sfCoords.iterTable('coordinate_files'):
-                    n = 0
-                    fomSum = 0
-                    with StarFile(self.project.join(row1.rlnMicrographCoordinates)) as sf:
-                        for row in sf.iterTable(''):
-                            n += 1
-                            fomSum += row.rlnAutopickFigureOfMerit
-                    pts.append(n)
-                    fom.append(fomSum / n)
+            for row in self._autopick_summary():
+                pts.append(row.count)
+                fom.append(row.meanFom)
 
         elif self.className == 'class2d':
             summary['template'] = 'processing_2d_summary.html'
@@ -219,6 +409,58 @@ class RelionRun(SessionRun):
 
         return summary
 
+    AUTOPICK_SUMMARY = 'emhub_autopick_summary.star'
+
+    def _autopick_summary(self, threads=8):
+        """ Return the number of particles and average FOM of each
+        micrograph of an autopick run.
+
+        The summary is stored in the run folder, with the mtime and size of
+        each coordinates file, so only new or modified files are read again.
+        Coordinate files are read in a pool of threads.
+        """
+        summaryStar = self.join(self.AUTOPICK_SUMMARY)
+        previous = {}
+        if os.path.exists(summaryStar):
+            with StarFile(summaryStar) as sf:
+                previous = {row.coordinates: row for row in sf.iterTable('summary')}
+
+        coordTable = star_cache.get_table(self.join('autopick.star'), 'coordinate_files')
+        coordFiles = [row.rlnMicrographCoordinates for row in coordTable]
+        table = Table(['coordinates', 'count', 'meanFom', 'mtime', 'size'])
+
+        def _summary(fn):
+            st = os.stat(self.project.join(fn))
+            prev = previous.get(fn, None)
+            if prev and prev.mtime == st.st_mtime_ns and prev.size == st.st_size:
+                return prev, False
+
+            n = 0
+            fomSum = 0
+            with StarFile(self.project.join(fn)) as sf:
+                for row in sf.iterTable(''):
+                    n += 1
+                    fomSum += row.rlnAutopickFigureOfMerit
+            return table.Row(fn, n, fomSum / max(n, 1), st.st_mtime_ns, st.st_size), True
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(_summary, coordFiles))
+
+        for row, _ in results:
+            table.addRowValues(*row)
+
+        if len(previous) != len(results) or any(changed for _, changed in results):
+            # Keep the summary only in memory if the run folder is not writable
+            try:
+                tmpStar = summaryStar + '.tmp'
+                with StarFile(tmpStar, 'w') as sf:
+                    sf.writeTable('summary', table)
+                os.replace(tmpStar, summaryStar)
+            except OSError:
+                pass
+
+        return table
+
     def getOverview(self):
         """
 
@@ -236,41 +478,33 @@ class RelionRun(SessionRun):
         return overview
 
     def _load_micrograph_data(self, micId, micsStar):
-        with StarFile(micsStar) as sf:
-            otable = sf.getTable('optics')
-            row = sf.getTableRow('micrographs', micId - 1)
-            micThumb = Thumbnail.Micrograph()
-            psdThumb = Thumbnail.Psd()
-            micFn = self.project.join(row.rlnMicrographName)
-            micThumbBase64 = micThumb.from_mrc(micFn)
-            psdFn = self.project.join(row.rlnCtfImage).replace(":mrc", "")
-            pixelSize = otable[0].rlnMicrographPixelSize
-            ctfProfile = psdFn.replace('.ctf', '_avrot.txt')
-
-            if os.path.exists(ctfProfile):
-                with open(ctfProfile) as f:
-                    ctfPlot = [line.split() for line in f
-                               if not line.startswith('#')]
-            else:
-                ctfPlot = []
-
-            print(f"PSD: {row.rlnMicrographName}")
+        otable = star_cache.get_table(micsStar, 'optics')
+        row = star_cache.get_table(micsStar, 'micrographs')[micId - 1]
+        # Images are rendered (and cached) by the images endpoints,
+        # here we only return the files relative to the project
+        micFn = row.rlnMicrographName
+        psdFn = row.rlnCtfImage.replace(":mrc", "")
+        pixelSize = otable[0].rlnMicrographPixelSize
+        micScale = thumbnail_scale(self.project.join(micFn),
+                                   THUMBNAIL_KINDS['micrograph']['size'])
+        ctfPlot = load_ctf_profile(self.project.join(ctf_profile_path(psdFn)),
+                                   cache=ThumbnailCache.shared(self.project.join('')))
 
-            return {
-                'micThumbData': micThumbBase64,
-                'psdData': psdThumb.from_mrc(psdFn),
-                'ctfDefocusU': round(row.rlnDefocusU / 10000., 2),
-                'ctfDefocusV': round(row.rlnDefocusV / 10000., 2),
-                'ctfDefocusAngle': round(row.rlnDefocusAngle, 2),
-                'ctfAstigmatism': round(row.rlnCtfAstigmatism / 10000, 2),
-                'ctfResolution': round(row.rlnCtfMaxResolution, 2),
-                'coordinates': [],  # Check for picking
-                'micThumbPixelSize': pixelSize * micThumb.scale,
-                'pixelSize': pixelSize,
-                'gridSquare': '',
-                'foilHole': '',
-                'ctfPlot': ctfPlot
-            }
+        return {
+            'micFile': micFn,
+            'psdFile': psdFn,
+            'ctfDefocusU': round(row.rlnDefocusU / 10000., 2),
+            'ctfDefocusV': round(row.rlnDefocusV / 10000., 2),
+            'ctfDefocusAngle': round(row.rlnDefocusAngle, 2),
+            'ctfAstigmatism': round(row.rlnCtfAstigmatism / 10000, 2),
+            'ctfResolution': round(row.rlnCtfMaxResolution, 2),
+            'coordinates': [],  # Check for picking
+            'micThumbPixelSize': pixelSize * micScale,
+            'pixelSize': pixelSize,
+            'gridSquare': '',
+            'foilHole': '',
+            'ctfPlot': ctfPlot
+        }
 
     def get_micrograph_data(self, micId):
         data = {}
@@ -290,92 +524,53 @@ class RelionRun(SessionRun):
 
     def get_classes2d(self, iteration=None):
         """ Get classes information from a class 2d run. """
-        items = []
-
-        if iteration:
-            avgMrcs = self.join('*_it%03d_classes.mrcs' % iteration)
-        else:
-            avgMrcs = self.join('*_it*_classes.mrcs')
-
-        if files := glob(avgMrcs):
-            files.sort()
-            avgMrcs = files[-1]
-            dataStar = avgMrcs.replace('_classes.mrcs', '_data.star')
-            modelStar = dataStar.replace('_data.', '_model.')
-
-            mrc_stack = None
-            avgThumb = Thumbnail(max_size=(100, 100),
-                                 output_format='base64')
-
-            with StarFile(dataStar) as sf:
-                n = sf.getTableSize('particles')
-
-            with StarFile(modelStar) as sf:
-                modelTable = sf.getTable('model_classes', guessType=False)
-
-                for row in modelTable:
-                    i, fn = row.rlnReferenceImage.split('@')
-                    if not mrc_stack:
-                        mrc_stack = mrcfile.open(avgMrcs, permissive=True)
-                    items.append({
-                        'id': '%03d' % int(i),
-                        'size': round(float(row.rlnClassDistribution) * n),
-                        'average': avgThumb.from_array(mrc_stack.data[int(i) - 1, :, :])
-                    })
-            items.sort(key=lambda c: c['size'], reverse=True)
-            mrc_stack.close()
-
-        return items
+        return get_classes2d_items(self.join(''), self.project.join(''),
+                                   iteration=iteration)
 
     def get_volume_data(self, volName, **kwargs):
+        """ Return info (dimensions, pixel size and range) or some slices
+        (base64 thumbnails) of a volume. Single slices are served as images
+        by images.volume_slice.
+        """
         volPath = self.join(volName)
 
         if not os.path.exists(volPath):
             raise Exception("Volume path %s does not exists." % volPath)
 
-        data = {}
-        volume_data = kwargs.get('volume_data', 'info')
-
-        mrc = mrcfile.open(volPath, permissive=True)
-        zdim, ydim, xdim = mrc.data.shape
+        data = volume_info(volPath)
         data['path'] = volPath
-        data['dimensions'] = [xdim, ydim, zdim]
+        volume_data = kwargs.get('volume_data', 'info')
 
         if volume_data == "info":
             return data
-        elif volume_data == "slices":
-            axis = kwargs.get('axis', 'z')
+        elif volume_data != "slices":
+            raise Exception('Unknown volume_data value: %s' % volume_data)
+
+        axis = kwargs.get('axis', 'z')
+        xdim, ydim, zdim = data['dimensions']
+        thumbSize = 128
+
+        # Memory-mapped, so only the requested slices are read from disk
+        with mrcfile.mmap(volPath, mode='r', permissive=True) as mrc:
+            # Slices along the given axis and the function to get them
+            dim, getSlice = {
+                'x': (xdim, lambda i: mrc.data[:, :, i]),
+                'y': (ydim, lambda i: mrc.data[:, i, :]),
+                'z': (zdim, lambda i: mrc.data[i, :, :])
+            }[axis]
 
-            thumbSize = 128
             volThumb = Thumbnail(max_size=(thumbSize, thumbSize),
                                  output_format='base64',
-                                 min_max=(mrc.data.min(), mrc.data.max()))
-            slices = {}
-            idx = np.round(np.linspace(0, xdim - 1, min(xdim, thumbSize))).astype(int)
-
-            print('idx', idx)
-
-            if axis == 'x':
-                for i in idx:
-                    slices = {int(i): volThumb.from_array(mrc.data[:, :, i])}
-            elif axis == 'y':
-                for i in idx:
-                    slices = {i: volThumb.from_array(mrc.data[:, i, :])}
+                                 min_max=data['range'])
+            if 'indexes' in kwargs:
+                idx = [int(i) for i in kwargs['indexes'] if 0 <= int(i) < dim]
             else:
-                for i in idx:
-                    slices = {int(i): volThumb.from_array(mrc.data[i, :, :])}
+                idx = np.round(np.linspace(0, dim - 1, min(dim, thumbSize))).astype(int)
 
             data.update({
-                'slices': slices,
+                'slices': {int(i): volThumb.from_array(getSlice(int(i))) for i in idx},
                 'axis': axis
             })
-        elif volume_data == 'array':
-            iMax = mrc.data.max()  # min(imean + 10 * isd, imageArray.max())
-            iMin = mrc.data.min()  # max(imean - 10 * isd, imageArray.min())
-            im255 = ((mrc.data - iMin) / (iMax - iMin) * 255).astype(np.uint8)
-            data['array'] = base64.b64encode(im255).decode("utf-8")
-        else:
-            raise Exception('Unknown volume_data value: %s' % volume_data)
 
         return data
 
@@ -384,30 +579,28 @@ class RelionSessionData(SessionData):
     """
     Adapter class for reading Session data from Relion OTF
     """
-    def get_stats(self):
+    def load_stats(self):
 
         def _stats_from_star(jobType, starFn, tableName, attribute):
             fn = self.get_last_star(jobType, starFn)
             if not fn or not os.path.exists(fn):
                 return {'count': 0}
-            with StarFile(fn) as sf:
-                if attribute == 'count':
-                    return {'count': sf.getTableSize(tableName)}
-                t = sf.getTable(tableName)
-                firstRow, lastRow = t[0], t[-1]
-                try:
-                    first = self.mtime(getattr(firstRow, attribute))
-                    last = self.mtime(getattr(lastRow, attribute))
-                    h = hours(first, last)
-                except:
-                    first = last = h = 0
-
-                return {
-                    'hours': h,
-                    'count': t.size(),
-                    'first': first,
-                    'last': last,
-                }
+            t = star_cache.get_table(fn, tableName)
+            if attribute == 'count':
+                return {'count': t.size()}
+            try:
+                first = self.mtime(getattr(t[0], attribute))
+                last = self.mtime(getattr(t[-1], attribute))
+                h = hours(first, last)
+            except:
+                first = last = h = 0
+
+            return {
+                'hours': h,
+                'count': t.size(),
+                'first': first,
+                'last': last,
+            }
 
         moviesStar = self.get_last_star('Import', 'movies.star')
         if not moviesStar:
@@ -433,122 +626,96 @@ class RelionSessionData(SessionData):
             'movies': movieStats,
             'ctfs': _stats_from_star('CtfFind', 'micrographs_ctf.star',
                                      'micrographs', 'rlnMicrographName'),
-            'classes2d': len(self.get_classes2d_runs()),
+            'classes2d': len(self.load_classes2d_runs()),
             'coordinates': {'count': 0}  # FIXME if there are picking jobs or from extraction
         }
 
         t.toc()
 
-    def get_micrographs(self):
-        """ Return an iterator over the micrographs' CTF information. """
+    def get_micrographs(self, start=0):
+        """ Return an iterator over the micrographs' CTF information,
+        from the start index. The STAR file is read incrementally.
+        """
         micFn = self._last_micFn()
 
         if not micFn:
             return []
 
-        with StarFile(micFn) as sf:
-            for row in sf.iterTable('micrographs'):
-                micData = {
-                    'micrograph': row.rlnMicrographName,
-                    'ctfImage': row.rlnCtfImage,
-                    'ctfDefocus': row.rlnDefocusU,
-                    'ctfResolution': min(row.rlnCtfMaxResolution, 10),
-                    'ctfDefocusAngle': row.rlnDefocusAngle,
-                    'ctfAstigmatism': row.rlnCtfAstigmatism
-                }
-                yield micData
+        for row in star_tails.get(micFn, 'micrographs').rows_since(start):
+            micData = {
+                'micrograph': row.rlnMicrographName,
+                'ctfImage': row.rlnCtfImage,
+                'ctfDefocus': row.rlnDefocusU,
+                'ctfResolution': min(row.rlnCtfMaxResolution, 10),
+                'ctfDefocusAngle': row.rlnDefocusAngle,
+                'ctfAstigmatism': row.rlnCtfAstigmatism
+            }
+            yield micData
 
     def get_micrograph_data(self, micId):
         micFn = self._last_micFn()
         data = {}
         if micFn:
-            with StarFile(micFn) as sf:
-                otable = sf.getTable('optics')
-                row = sf.getTableRow('micrographs', micId - 1)
-                micThumb = Thumbnail.Micrograph()
-                psdThumb = Thumbnail.Psd()
-                micFn = self.join(row.rlnMicrographName)
-                micThumbBase64 = micThumb.from_mrc(micFn)
-                psdFn = self.join(row.rlnCtfImage).replace(':mrc', '')
-                pixelSize = otable[0].rlnMicrographPixelSize
-
-                loc = EPU.get_movie_location(micFn)
-
-                if pickStar := self.get_last_star('*Pick', '*pick.star'):
-                    coords = self.get_micrograph_coordinates(pickStar, micId)
-                else:
-                    coords = []
-
-                data = {
-                    'micThumbData': micThumbBase64,
-                    'psdData': psdThumb.from_mrc(psdFn),
-                    # 'shiftPlotData': None,
-                    'ctfDefocusU': round(row.rlnDefocusU/10000., 2),
-                    'ctfDefocusV': round(row.rlnDefocusV/10000., 2),
-                    'ctfDefocusAngle': round(row.rlnDefocusAngle, 2),
-                    'ctfAstigmatism': round(row.rlnCtfAstigmatism/10000, 2),
-                    'ctfResolution': round(row.rlnCtfMaxResolution, 2),
-                    'coordinates': coords,
-                    'micThumbPixelSize': pixelSize * micThumb.scale,
-                    'pixelSize': pixelSize,
-                    'gridSquare': loc['gs'],
-                    'foilHole': loc['fh']
-                }
-        return data
-
-    def get_workflow(self):
-        protList = []
-        protDict = {}
-        status_map = {
-            'Succeeded': 'finished',
-            'Running': 'running',
-            'Aborted': 'aborted',
-            'Failed': 'failed'
-        }
-        pipelineStar = self.join('default_pipeline.star')
-        outputs = {}
+            otable = star_cache.get_table(micFn, 'optics')
+            row = star_cache.get_table(micFn, 'micrographs')[micId - 1]
+            micFn = row.rlnMicrographName
+            psdFn = row.rlnCtfImage.replace(':mrc', '')
+            pixelSize = otable[0].rlnMicrographPixelSize
+            micScale = thumbnail_scale(self.join(micFn),
+                                       THUMBNAIL_KINDS['micrograph']['size'])
 
-        with StarFile(pipelineStar) as sf:
-            for row in sf.iterTable('pipeline_processes'):
-                name = row.rlnPipeLineProcessName
-                alias = row.rlnPipeLineProcessAlias
-                status = status_map.get(row.rlnPipeLineProcessStatusLabel, 'unknown')
-                prot = {
-                    'id': name,
-                    'label': alias if alias != 'None' else name,
-                    'links': [],
-                    'status': status,
-                    'type': row.rlnPipeLineProcessTypeLabel
-                }
-                protList.append(prot)
-                protDict[name] = prot
+            loc = EPU.get_movie_location(micFn)
 
-            for row in sf.iterTable('pipeline_output_edges'):
-                outputs[row.rlnPipeLineEdgeToNode] = row.rlnPipeLineEdgeProcess
+            if pickStar := self.get_last_star('*Pick', '*pick.star'):
+                coords = self.get_micrograph_coordinates(pickStar, micId)
+            else:
+                coords = []
+
+            data = {
+                'micFile': micFn,
+                'psdFile': psdFn,
+                # 'shiftPlotData': None,
+                'ctfDefocusU': round(row.rlnDefocusU/10000., 2),
+                'ctfDefocusV': round(row.rlnDefocusV/10000., 2),
+                'ctfDefocusAngle': round(row.rlnDefocusAngle, 2),
+                'ctfAstigmatism': round(row.rlnCtfAstigmatism/10000, 2),
+                'ctfResolution': round(row.rlnCtfMaxResolution, 2),
+                'coordinates': coords,
+                'micThumbPixelSize': pixelSize * micScale,
+                'pixelSize': pixelSize,
+                'gridSquare': loc['gs'],
+                'foilHole': loc['fh']
+            }
+        return data
 
-            for row in sf.iterTable('pipeline_input_edges'):
-                node = row.rlnPipeLineEdgeFromNode
-                if output := outputs.get(node, None):
-                    procName = row.rlnPipeLineEdgeProcess
-                    childProt = protDict[procName]
-                    parentProt = protDict[output]
-                    if childProt not in parentProt['links']:
-                        parentProt['links'].append(procName)
+    def get_workflow(self):
+        pipeline = self.pipeline()
+        if pipeline is None:
+            return []
 
-        return protList
+        return [{
+            'id': name,
+            'label': proc['label'],
+            'links': pipeline.get_links(name),
+            'status': proc['status'],
+            'type': proc['type']
+        } for name, proc in pipeline.processes.items()]
 
     def get_run(self, runId):
         return RelionRun(self, self.join(runId))
 
-    def get_classes2d_runs(self):
-        return [r.replace(self._path, '')[1:] for r in self._jobs('Class2D')]
+    def load_classes2d_runs(self):
+        return [Path.rmslash(r.replace(self._path, '')[1:]) for r in self._jobs('Class2D')]
 
-    def get_classes2d_from_run(self, runId=None):
+    def get_classes2d(self, runId=None):
         """ Iterate over 2D classes. """
         runs2d = self.get_classes2d_runs()
+        items = []
+        if runId is not None and runs2d:
+            items = get_classes2d_items(self.join(runs2d[runId]), self.join(''))
         return {
             'runs': [{'id': i, 'label': r} for i, r in enumerate(runs2d)],
-            'items': [] if runId is None else self.get_classes2d(self.join(runs2d[runId])),
+            'items': items,
             'selection': []
         }
 
@@ -571,15 +738,38 @@ class RelionSessionData(SessionData):
                     return self.get_coords_from_star(row.rlnMicrographCoordinates)
         return []
 
-    # ----------------------- UTILS ---------------------------
-    def _jobs(self, jobType):
-        jobs = glob(self.join(jobType, 'job*'))
+    def get_micrograph_particles(self, micName):
+        pickStar = self.get_last_star('*Pick', '*pick.star')
+        if not pickStar or not os.path.exists(pickStar):
+            return 0
+
+        def _load(fn):
+            with StarFile(fn) as sf:
+                return {row.rlnMicrographName: row.rlnMicrographCoordinates
+                        for row in sf.iterTable('coordinate_files')}
 
-        def _jobNumber(j):
-            return int(j.split('/job')[1])
+        coordFn = star_cache.get(pickStar, 'coordinates_by_mic', _load).get(micName, None)
+        if not coordFn or not os.path.exists(self.join(coordFn)):
+            return 0
+        with StarFile(self.join(coordFn)) as sf:
+            return sf.getTableSize('')
 
-        jobs.sort(key=_jobNumber)
+    # ----------------------- UTILS ---------------------------
+    def pipeline(self):
+        """ Return the PipelineIndex of the project, or None if there
+        is no default_pipeline.star yet. """
+        pipelineStar = self.join('default_pipeline.star')
+        if not os.path.exists(pipelineStar):
+            return None
+        return star_cache.get(pipelineStar, 'pipeline', PipelineIndex)
 
+    def _jobs(self, jobType):
+        """ Return the job folders of a given type, sorted by job number. """
+        if pipeline := self.pipeline():
+            return [self.join(name) for name in pipeline.get_jobs(jobType)]
+
+        jobs = glob(self.join(jobType, 'job*'))
+        jobs.sort(key=PipelineIndex.job_number)
         return jobs
 
     def get_last_star(self, jobType, starFn):
@@ -588,7 +778,12 @@ class RelionSessionData(SessionData):
             return None
         fn = self.join(jobDirs[-1], starFn)
         if '*' in starFn:  # it is a glob pattern, let's find the last file
-            files = glob(fn)
+            pipeline = self.pipeline()
+            jobName = os.path.relpath(jobDirs[-1], self.join('')) + '/'
+            files = [self.join(node) for node in
+                     (pipeline.outputs.get(jobName, []) if pipeline else [])
+                     if fnmatch(node, os.path.join(jobName, starFn))]
+            files = files or glob(fn)
             files.sort()
             fn = files[-1] if files else None
         return fn
@@ -19,13 +19,22 @@ import datetime as dt
 from glob import glob
 from collections import defaultdict
 import json
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from contextlib import closing
 
 import mrcfile
 from emtools.utils import Path, Timer, Pretty
 from emtools.metadata import StarFile, EPU, SqliteFile
 from emtools.image import Thumbnail
 
+from emhub.utils.image import (thumbnail_scale, THUMBNAIL_KINDS, ThumbnailCache,
+                               load_ctf_profile, ctf_profile_path)
 from .base import SessionRun, SessionData, hours
+from .cache import star_cache
+from .processing_relion import get_classes2d_items
 
 
 class ScipionRun(SessionRun):
@@ -150,6 +159,167 @@ class ScipionRun(SessionRun):
         return data_values
 
 
+class CoordinatesIndex:
+    """ Index of the particles' coordinates by micrograph, built from
+    a Scipion coordinates.sqlite file into a sidecar SQLite DB.
+
+    When the source changes (mtime or size), only its rows after the last
+    indexed id are added. The index is built again if the source was
+    replaced (other inode) or has fewer rows. The source signature is kept
+    in memory, so the sidecar is only opened to update it when the source
+    changed. It is stored in the project folder if writable, if not, in
+    the temporary folder.
+    """
+    FILENAME = 'emhub_coordinates.sqlite'
+
+    def __init__(self, projectPath, coordSqlite):
+        self.source = coordSqlite
+        if os.access(projectPath, os.W_OK):
+            self.path = os.path.join(projectPath, self.FILENAME)
+        else:
+            key = hashlib.sha1(os.path.abspath(coordSqlite).encode()).hexdigest()
+            self.path = os.path.join(tempfile.gettempdir(), 'emhub-coords-%s.sqlite' % key)
+        self.signature = None  # (mtime, size) of the source when last updated
+        self._lock = threading.Lock()
+
+    def build(self):
+        """ Create the empty index, rows are added by append. """
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        os.close(fd)
+        try:
+            with closing(sqlite3.connect(tmpPath)) as con:
+                con.execute("CREATE TABLE coordinates (micName TEXT, x, y)")
+                con.execute("CREATE INDEX coordinates_micName ON coordinates (micName)")
+                con.execute("CREATE TABLE meta (mtime INTEGER, size INTEGER, "
+                            "inode INTEGER, lastId INTEGER)")
+                con.execute("INSERT INTO meta VALUES (0, 0, 0, 0)")
+                con.commit()
+            os.replace(tmpPath, self.path)
+        except:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+    def append(self, st):
+        """ Copy micName, x and y of the source rows after the last indexed
+        id. Return False if the index needs to be built again.
+
+        Args:
+            st: os.stat result of the source.
+        """
+        with closing(sqlite3.connect('file:%s' % self.path, uri=True,
+                                     isolation_level=None)) as con:
+            con.execute("ATTACH DATABASE ? AS src",
+                        ('file:%s?mode=ro' % self.source,))
+            # Other processes could be updating the same index
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                mtime, size, inode, lastId = con.execute(
+                    "SELECT mtime, size, inode, lastId FROM meta").fetchone()
+                if (mtime, size) != (st.st_mtime_ns, st.st_size):
+                    maxId = con.execute("SELECT MAX(id) FROM src.Objects").fetchone()[0] or 0
+                    if lastId and (inode != st.st_ino or maxId < lastId):
+                        con.execute("ROLLBACK")
+                        return False
+                    cols = dict(con.execute("SELECT label_property, column_name "
+                                            "FROM src.Classes"))
+                    con.execute('INSERT INTO coordinates SELECT "%s", "%s", "%s" '
+                                'FROM src.Objects WHERE id > ? AND id <= ? ORDER BY id'
+                                % (cols['_micName'], cols['_x'], cols['_y']),
+                                (lastId, maxId))
+                    con.execute("UPDATE meta SET mtime=?, size=?, inode=?, lastId=?",
+                                (st.st_mtime_ns, st.st_size, st.st_ino, maxId))
+                con.execute("COMMIT")
+            except:
+                con.execute("ROLLBACK")
+                raise
+        return True
+
+    def update(self):
+        """ Add the new rows of the source to the index, if it changed. """
+        st = os.stat(self.source)
+        signature = st.st_mtime_ns, st.st_size
+        with self._lock:
+            if signature == self.signature:
+                return
+            try:
+                updated = os.path.exists(self.path) and self.append(st)
+            except sqlite3.Error:  # e.g. index from an old format
+                updated = False
+            if not updated:
+                self.build()
+                self.append(st)
+            self.signature = signature
+
+    def get(self, micName):
+        """ Return the (x, y) coordinates of a micrograph. """
+        self.update()
+        with closing(sqlite3.connect('file:%s?mode=ro' % self.path, uri=True)) as con:
+            return con.execute("SELECT x, y FROM coordinates WHERE micName=? "
+                               "ORDER BY rowid", (micName,)).fetchall()
+
+
+class ProjectDb:
+    """ Read-only access to the Objects table of a Scipion project.sqlite,
+    only fetching the rows needed by each query instead of iterating
+    the whole table.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def query(self, sql, params=()):
+        """ Return the rows of the query as dicts. """
+        with closing(sqlite3.connect('file:%s?mode=ro' % self.path, uri=True)) as con:
+            con.row_factory = sqlite3.Row
+            return [dict(row) for row in con.execute(sql, params)]
+
+    def get_protocols(self):
+        return self.query("SELECT id, label, classname FROM Objects "
+                          "WHERE parent_id IS NULL AND name != 'CreationTime' "
+                          "ORDER BY id")
+
+    def get_workflow(self):
+        """ Return the list of protocols, with the ids of the protocols
+        (or pointer lists) that use them as input in 'links'. """
+        protList = []
+        protDict = {}
+
+        for row in self.get_protocols():
+            prot = {
+                'id': row['id'],
+                'label': row['label'],
+                'links': [],
+                'status': 'finished',
+                'type': row['classname']
+            }
+            protList.append(prot)
+            protDict[prot['id']] = prot
+
+        for row in self.query("SELECT parent_id, value FROM Objects "
+                              "WHERE classname='Pointer' AND value IS NOT NULL "
+                              "AND name NOT LIKE '%outputs%' ORDER BY id"):
+            if row['value']:
+                rid = int(row['value'])
+                if rid in protDict:
+                    protDict[rid]['links'].append(row['parent_id'])
+
+        for row in self.query("SELECT parent_id, value FROM Objects "
+                              "WHERE name LIKE '%.status' ORDER BY id"):
+            if row['parent_id'] in protDict:
+                protDict[row['parent_id']]['status'] = row['value']
+
+        return protList
+
+    def get_run_rows(self, runId):
+        """ Return the rows of a protocol and its attributes, by name. """
+        rid = int(runId)
+        rows = self.query("SELECT * FROM Objects WHERE id=? OR name LIKE ? "
+                          "ORDER BY id", (rid, '%d.%%' % rid))
+        if not any(row['id'] == rid for row in rows):
+            raise Exception("Run %s not found in %s" % (runId, self.path))
+        return {row['name']: row for row in rows}
+
+
 class ScipionSessionData(SessionData):
     """
     Adapter class for reading Session data from Relion OTF
@@ -180,6 +350,7 @@ class ScipionSessionData(SessionData):
         outputs['select2d'] = glob(self.join('Runs', '??????_ProtRelionSelectClasses2D'))
         outputs['select2d'].sort()
         self.outputs = outputs
+        self._coordinates = None  # CoordinatesIndex, kept to update it
 
     def _stats_from_sqlite(self, sqliteFn, fileKey=None):
         stats = {
@@ -203,7 +374,7 @@ class ScipionSessionData(SessionData):
     def _stats_from_output(self, outputKey, fileKey=None):
         return self._stats_from_sqlite(self.outputs.get(outputKey, None), fileKey)
 
-    def get_stats(self):
+    def load_stats(self):
         if 'movies' not in self.outputs:
             return {'movies': {'count': 0}, 'ctfs': {'count': 0}}
 
@@ -226,14 +397,15 @@ class ScipionSessionData(SessionData):
             'classes2d': len(self.outputs['classes2d'])
         }
 
-    def get_micrographs(self):
-        """ Return an iterator over the micrographs' CTF information. """
+    def get_micrographs(self, start=0):
+        """ Return an iterator over the micrographs' CTF information,
+        from the start index. """
         if 'ctfs' not in self.outputs:
             return []
 
         ctfSqlite = self.outputs['ctfs']
         with SqliteFile(ctfSqlite) as sf:
-            for row in sf.iterTable('Objects', classes='Classes'):
+            for row in sf.iterTable('Objects', classes='Classes', start=start):
                 # yield row
                 # continue
                 dU, dV = row['_defocusU'], row['_defocusV']
@@ -266,30 +438,23 @@ class ScipionSessionData(SessionData):
         if ctfSqlite and os.path.exists(ctfSqlite):
             with SqliteFile(ctfSqlite) as sf:
                 row = sf.getTableRow('Objects', micId - 1, classes='Classes')
-                micThumb = Thumbnail.Micrograph()
-                psdThumb = Thumbnail.Psd()
                 micName = row['_micObj._micName']
-                micFn = self.join(row['_micObj._filename'])
-                micThumbBase64 = micThumb.from_mrc(micFn)
-                psdFn = self.join(row['_psdFile']).replace(':mrc', '')
+                micFn = row['_micObj._filename']
+                psdFn = row['_psdFile'].replace(':mrc', '')
                 pixelSize = row['_micObj._samplingRate']
+                micScale = thumbnail_scale(self.join(micFn),
+                                           THUMBNAIL_KINDS['micrograph']['size'])
 
-                ctfProfile = psdFn.replace('.mrc', '_avrot.txt')
-                if os.path.exists(ctfProfile):
-                    with open(ctfProfile) as f:
-                        ctfPlot = [line.split() for line in f
-                                   if not line.startswith('#')]
-                else:
-                    ctfPlot = []
+                ctfPlot = load_ctf_profile(self.join(ctf_profile_path(psdFn)),
+                                           cache=ThumbnailCache.shared(self.join('')))
 
                 loc = EPU.get_movie_location(micName)
                 data = ScipionSessionData.ctf_from_row(row)
                 data.update({
-                    'micThumbData': micThumbBase64,
-                    'psdData': psdThumb.from_mrc(psdFn),
-                    # TODO: Retrieving coordinates from multiple micrographs is very slow now
+                    'micFile': micFn,
+                    'psdFile': psdFn,
                     'coordinates': self.get_micrograph_coordinates(row['_micObj._micName']),
-                    'micThumbPixelSize': pixelSize * micThumb.scale,
+                    'micThumbPixelSize': pixelSize * micScale,
                     'pixelSize': pixelSize,
                     'gridSquare': loc['gs'],
                     'foilHole': loc['fh'],
@@ -300,6 +465,10 @@ class ScipionSessionData(SessionData):
     def get_micrograph_data(self, micId):
         return self.load_mic_data(micId, self.outputs.get('ctfs', None))
 
+    def load_classes2d_runs(self):
+        return [os.path.relpath(os.path.dirname(fn), self.join(''))
+                for fn in self.outputs['classes2d']]
+
     def get_classes2d(self, runId=None):
         """ Iterate over 2D classes. """
         classes2d = {
@@ -343,69 +512,25 @@ class ScipionSessionData(SessionData):
                                                       for row in table if row.rlnEstimatedResolution < 30]
                             break
             runFolder = os.path.join(os.path.dirname(classesSqlite), 'extra')
-            classes2d['items'] = RelionSessionData.get_classes2d_from_run(runFolder)
+            classes2d['items'] = get_classes2d_items(runFolder, self.join(''))
 
         return classes2d
 
     def get_micrograph_coordinates(self, micFn):
-        self.all_coords = getattr(self, 'all_coords', None)
-        if self.all_coords is None:
-            coords = defaultdict(lambda: [])
-            with Timer():
-                if coordSqlite := self.outputs.get('coordinates', None):
-                    with SqliteFile(coordSqlite) as sf:
-                        for row in sf.iterTable('Objects', classes='Classes'):
-                            coords[row['_micName']].append((row['_x'], row['_y']))
-            self.all_coords = coords
-
-        return self.all_coords[micFn]
+        if coordSqlite := self.outputs.get('coordinates', None):
+            if self._coordinates is None or self._coordinates.source != coordSqlite:
+                self._coordinates = CoordinatesIndex(self.join(''), coordSqlite)
+            return self._coordinates.get(micFn)
+        return []
 
     def get_workflow(self):
-        protList = []
-        protDict = {}
-
-        with SqliteFile(self.join('project.sqlite')) as sf:
-            for row in sf.iterTable('Objects'):
-                name = row['name']
-                pid = row['parent_id']
-
-                if row['parent_id'] is None and name != 'CreationTime':
-                    prot = {
-                        'id': row['id'],
-                        'label': row['label'],
-                        'links': [],
-                        'status': 'finished',
-                        'type': row['classname']
-                    }
-                    protList.append(prot)
-                    protDict[prot['id']] = prot
-                elif 'outputs' in name:
-                    pass
-                elif row['classname'] == 'Pointer':
-                    if row['value']:
-                        rid = int(row['value'])
-                        if rid in protDict:
-                            protDict[rid]['links'].append(pid)
-
-                    if pid in protDict:
-                        pass
-                elif 'status' in name:
-                    # Update protocol status
-                    protDict[pid]['status'] = row['value']
-        return protList
+        """ Return the protocols and their links, cached until the
+        project DB changes. """
+        return star_cache.get(self.join('project.sqlite'), 'workflow',
+                              lambda p: ProjectDb(p).get_workflow())
 
     def get_run(self, runId):
-        prefix = f'{runId}.'
-        runDict = {}
-        rid = int(runId)
-
-        with SqliteFile(self.join('project.sqlite')) as sf:
-            for row in sf.iterTable('Objects'):
-                name = row['name']
-                if row['id'] == rid or name.startswith(prefix):
-                    runDict[name] = row
-
-        return ScipionRun(self, runDict)
+        return ScipionRun(self, ProjectDb(self.join('project.sqlite')).get_run_rows(runId))
 
     @staticmethod
     def getFormDefinition(className):
@@ -0,0 +1,129 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. de la Rosa Trevin (delarosatrevin@gmail.com)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# **************************************************************************
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+from contextlib import closing
+
+from .cache import star_cache
+from .ctf_store import get_gridsquare_index
+
+
+class SessionSummary:
+    """ Compact summary of a processing project, kept in an SQLite DB
+    in the project folder.
+
+    It is written by the indexer task of the session worker, that follows
+    the active sessions, and read by the SessionData adapters instead of
+    the raw output files. It contains the stats, the gridsquares (with
+    their number of micrographs) and the 2D classification runs. The CTF
+    columns are kept up to date by the indexer in the CtfStore
+    (emhub_ctf.npz).
+
+    The version is increased when the content changes. If the file was not
+    updated in the last MAX_AGE seconds (the indexer is not running), the
+    summary is not used and the adapters read the raw files.
+    """
+    FILENAME = 'emhub_summary.sqlite'
+    MAX_AGE = 600
+
+    def __init__(self, projectPath):
+        self.projectPath = projectPath
+        self.path = os.path.join(projectPath, self.FILENAME)
+
+    def _read(self, path):
+        with closing(sqlite3.connect('file:%s?mode=ro' % path, uri=True)) as con:
+            summary = {k: json.loads(v) for k, v in con.execute("SELECT key, value FROM meta")}
+            summary['gridsquares'] = [
+                {'gsId': gs, 'micrographs': mics}
+                for gs, mics in con.execute(
+                    "SELECT gsId, micrographs FROM gridsquares ORDER BY rowid")]
+        return summary
+
+    def load(self, max_age=None):
+        """ Return the summary as a dict, or None if it does not exist
+        or it is older than max_age seconds (MAX_AGE by default). """
+        max_age = max_age or self.MAX_AGE
+        try:
+            if time.time() - os.path.getmtime(self.path) > max_age:
+                return None
+            return star_cache.get(self.path, 'summary', self._read)
+        except (OSError, sqlite3.Error):
+            return None
+
+    @staticmethod
+    def build(sdata):
+        """ Compute the summary values from the raw files of the project
+        (sdata, a SessionData). """
+        stats = sdata.load_stats()
+        count = stats['ctfs']['count']
+        gridsquares = []
+
+        if count > 0:
+            gsIndex = get_gridsquare_index(sdata.join(''))
+            gsIndex.update(sdata, count=count)
+            gridsquares = gsIndex.gridsquares()
+
+        return {
+            'stats': stats,
+            'classes2d_runs': sdata.load_classes2d_runs(),
+            'gridsquares': gridsquares
+        }
+
+    def write(self, values):
+        """ Write the values (from build) in the summary DB, return the
+        version. The DB is only written again if the values changed,
+        otherwise its mtime is updated to mark that it is up to date. """
+        content = json.dumps(values, sort_keys=True, default=str)
+        digest = hashlib.sha1(content.encode()).hexdigest()
+        previous = self.load(max_age=float('inf'))
+
+        if previous is not None and previous.get('digest', None) == digest:
+            os.utime(self.path)
+            return previous['version']
+
+        version = previous['version'] + 1 if previous else 1
+        meta = {
+            'version': version,
+            'digest': digest,
+            'updated': time.time(),
+            'stats': values['stats'],
+            'classes2d_runs': values['classes2d_runs']
+        }
+
+        fd, tmpPath = tempfile.mkstemp(dir=self.projectPath, suffix='.tmp')
+        os.close(fd)
+        try:
+            with closing(sqlite3.connect(tmpPath)) as con:
+                con.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+                con.executemany("INSERT INTO meta VALUES (?, ?)",
+                                [(k, json.dumps(v, default=str)) for k, v in meta.items()])
+                con.execute("CREATE TABLE gridsquares (gsId TEXT, micrographs INTEGER)")
+                con.executemany("INSERT INTO gridsquares VALUES (?, ?)",
+                                [(gs['gsId'], gs['micrographs'])
+                                 for gs in values['gridsquares']])
+                con.commit()
+            os.replace(tmpPath, self.path)
+        except:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+        return version
@@ -434,7 +434,7 @@ function drawMicrograph(containerId, micrograph, drawCoordinates) {
         }
     };
 
-    image.src = 'data:image/png;base64,' + micrograph.thumbnail;
+    image.src = micrograph.thumbnail;
 }
 
 function drawClasses2d(containerId, classes, header, showSel){
@@ -444,7 +444,15 @@ function drawClasses2d(containerId, classes, header, showSel){
 
     for (var cls2d of classes) {
         let borderColor = showSel && cls2d.sel ? 'limegreen' : 'white';
-        imgStr = '<img src="data:image/png;base64,' + cls2d.average + '" style="border: solid 3px ' + borderColor + ';">';
+        if (cls2d.sprite) {
+            // Tile of the sprite sheet with all class averages
+            let [x, y, w, h] = cls2d.tile;
+            imgStr = '<div style="width: ' + w + 'px; height: ' + h + 'px; ' +
+                     'background: url(' + cls2d.sprite + ') -' + x + 'px -' + y + 'px; ' +
+                     'box-sizing: content-box; border: solid 3px ' + borderColor + ';"></div>';
+        }
+        else
+            imgStr = '<img src="' + cls2d.average + '" style="border: solid 3px ' + borderColor + ';">';
         infoStr = '<p class="text-muted mb-0"><small>size: ' + cls2d.size + ', id: ' + cls2d.id + '</small></p>';
         html += '<div style="padding: 3px; min-width: 90px;">' + imgStr + infoStr + '</div>';
 
@@ -465,6 +473,81 @@ function drawVolData(containerId, volSlices){
     container.innerHTML = html;
 }
 
+/* Show the slices of a volume one at a time, loading them on demand
+ * from images.volume_slice. Loaded slices are kept (up to maxSlices,
+ * the least recently used are dropped) and the ones around the current
+ * index (+/- prefetch) are requested in advance, so moving through
+ * the volume does not wait for the server.
+ */
+class VolumeSlicer {
+    constructor(params, img, options) {
+        options = options || {};
+        this.params = params;
+        this.img = img;
+        this.size = options.size || 256;
+        this.prefetch = options.prefetch || 4;
+        this.maxSlices = options.maxSlices || 128;
+        this.cache = new Map();  // key -> Image, in order of use
+        this.info = null;
+        this.axis = 'z';
+        this.index = 0;
+    }
+
+    load() {
+        let self = this;
+        return $.ajax({
+            url: Api.urls.volume_info,
+            type: "GET",
+            data: this.params,
+            dataType: "json"
+        }).then(function (info) {
+            self.info = info;
+            self.cache.clear();
+            self.show(self.axis, Math.floor(self.dim() / 2));
+            return info;
+        });
+    }
+
+    dim(axis) {
+        return this.info.dimensions['xyz'.indexOf(axis || this.axis)];
+    }
+
+    url(axis, index) {
+        // The version changes the URL if the volume is written again
+        return Api.urls.volume_slice + '?' + $.param(
+            Object.assign({axis: axis, index: index, size: this.size,
+                           v: this.info.version}, this.params));
+    }
+
+    getSlice(axis, index) {
+        let key = axis + index;
+        let img = this.cache.get(key);
+        if (img === undefined) {
+            img = new Image();
+            img.src = this.url(axis, index);
+            if (this.cache.size >= this.maxSlices)
+                this.cache.delete(this.cache.keys().next().value);
+        }
+        else
+            this.cache.delete(key);
+        this.cache.set(key, img);
+        return img;
+    }
+
+    show(axis, index) {
+        this.axis = axis;
+        this.index = Math.max(0, Math.min(index, this.dim() - 1));
+        this.img.src = this.getSlice(this.axis, this.index).src;
+
+        for (let d = 1; d <= this.prefetch; d++) {
+            for (let i of [this.index + d, this.index - d])
+                if (i >= 0 && i < this.dim())
+                    this.getSlice(this.axis, i);
+        }
+        return this.index;
+    }
+}
+
 class Overlay {
     constructor(containerId) {
         this.container = document.getElementById(containerId);
@@ -544,7 +627,7 @@ class MicrographCard {
 
         requestMicThumb.done(function(data) {
             micrograph = {
-                thumbnail: data['micThumbData'],
+                thumbnail: data['micThumbUrl'],
                 coordinates: data['coordinates'],
                 pixelSize: data['pixelSize'],
                 thumbnailPixelSize: data['micThumbPixelSize']
@@ -557,7 +640,7 @@ class MicrographCard {
                 self.gsCard.loadData(data.gridSquare);
             }
 
-            $(self.jid('img_psd')).attr('src', 'data:image/png;base64,' + data.psdData);
+            $(self.jid('img_psd')).attr('src', data.psdUrl);
             function setLabel(containerId, value){
                 var elem = document.getElementById(containerId);
                 var parts = elem.innerHTML.split(":");
@@ -634,7 +717,7 @@ class GridSquareCard {
                 $(self.jid('name')).text(gridSquare);
                 $(self.jid('micrographs')).text(data.defocus.length);
                 $(self.jid('particles')).text(data.particles);
-                $(self.jid('image')).attr('src', 'data:image/png;base64,' + data.gridSquare.thumbnail);
+                $(self.jid('image')).attr('src', data.gridSquare.thumbnail);
                 create_hc_defocus_histogram(self.id('defocus_hist'), data.defocus, 80);
                 create_hc_resolution_histogram(self.id('resolution_hist'), data.resolution, 80);
             }
@@ -729,15 +812,22 @@ function session_getData(attrs) {
 
                     overlay_2d.hide();
                 }
-                else if ('defocus' in jsonResponse) {
+                else if ('defocus' in jsonResponse || jsonResponse.unchanged) {
                     var count = session_data == null ? 0 : session_data.resolution.length;
-                    session_data = jsonResponse;
-                    // TODO: Update Defocus plot with new values since last time
+                    if (!jsonResponse.unchanged)
+                        session_mergeData(jsonResponse);
                     var new_count = session_data.resolution.length;
-                    if (new_count > count) {
+                    // A full response (since=0) replaces all values
+                    var reset = count > 0 && !jsonResponse.unchanged && !jsonResponse.since;
+                    if (new_count > count || reset) {
+                        // Plots are created again with all values
+                        session_plots = null;
                         session_updatePlots();
-                        mic_card.loadMicData(new_count);
+                        if (new_count > 0)
+                            mic_card.loadMicData(new_count);
                     }
+                    else if (!jsonResponse.unchanged)
+                        session_updateCounters();
 
                     if (session_data.session.status != "finished") {
                         setTimeout(session_reload, 60000);
@@ -753,7 +843,33 @@ function session_getData(attrs) {
 
 
 function session_reload() {
-    session_getData({result: 'micrographs'});
+    var attrs = {result: 'micrographs'};
+    // Only request the micrographs (and movies) that we do not have yet
+    if (session_data != null) {
+        attrs.since = session_data.micrographs_count;
+        attrs.since_movies = session_data.movies_count;
+        attrs.version = session_data.version;
+    }
+    session_getData(attrs);
+}
+
+
+function session_mergeData(delta) {
+    /* Append the new rows of a delta response from get_session_data
+    * to session_data. Other values (stats, bins, etc) replace the old ones.
+    * */
+    if (session_data == null || !delta.since) {
+        session_data = delta;
+        return;
+    }
+    const arrays = ['defocus', 'defocusAngle', 'astigmatism', 'resolution',
+                    'gridsquares', 'beamshifts'];
+    for (const key in delta) {
+        if (arrays.includes(key))
+            session_data[key] = session_data[key].concat(delta[key]);
+        else if (key != 'tsRange' || nonEmpty(delta.tsRange))
+            session_data[key] = delta[key];
+    }
 }
 
 
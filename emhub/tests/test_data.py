@@ -26,13 +26,24 @@
 # *
 # **************************************************************************
 
+import os
+import time
+import shutil
+import tempfile
 import unittest
 import datetime as dt
 from pprint import pprint
 
+import flask
+
 from emhub.data import DataManager, DataLog
+from emhub.data.content import DataContent
+from emhub.data.content.dc_base import BookingSerializer
+from emhub.data.processing.base import SessionData
+from emhub.data.processing.ctf_store import CtfStore
+from emhub.data.processing.summary import SessionSummary
 from emhub.data.imports.test import TestData
-from emhub.utils import datetime_to_isoformat
+from emhub.utils import datetime_to_isoformat, pretty_datetime, shortname
 
 
 class TestDataManager(unittest.TestCase):
@@ -99,6 +110,23 @@ class TestDataManager(unittest.TestCase):
             for u in members[1:]:
                 self.assertEqual(pRef, u.get_applications())
 
+    def test_lab_directory(self):
+        directory = self.dm.get_lab_directory()
+        pis = [u for u in self.dm.get_users() if u.is_pi]
+        self.assertEqual(set(directory.labs.keys()), set(u.id for u in pis))
+
+        for pi in pis:
+            lab = directory.labs[pi.id]
+            self.assertEqual(lab[0]['id'], pi.id)
+            self.assertEqual(set(u['id'] for u in lab[1:]),
+                             set(u.id for u in pi.get_lab_members()))
+
+        # The directory is reused until users are modified
+        self.assertIs(directory, self.dm.get_lab_directory())
+        pi = pis[0]
+        self.dm.update_user(id=pi.id, name=pi.name)
+        self.assertIsNot(directory, self.dm.get_lab_directory())
+
     def test_bookings(self):
         # Retrieve all bookings that are either booking or downtime
         typeCond = "type='booking' OR type='downtime'"
@@ -112,6 +140,42 @@ class TestDataManager(unittest.TestCase):
         bookings = self.dm.get_bookings(condition=startCond)
         self.assertEqual(len(bookings), 3)
 
+        # Eager loading of relations should not change the results
+        eager = self.dm.get_bookings(condition=startCond, eager=True)
+        self.assertEqual([b.id for b in bookings], [b.id for b in eager])
+        self.assertEqual([b.owner.id for b in bookings],
+                         [b.owner.id for b in eager])
+
+    def test_booking_serializer(self):
+        """ Compare the events from BookingSerializer with the ones from
+        the previous per-booking code (booking_to_event_ref). """
+        dm = self.dm
+        keywords = ['cycle', 'installation', 'maintenance', 'afis']
+        bookings = [b for b in dm.get_bookings(eager=True) if b.type == 'booking'
+                    and not any(k in b.title for k in keywords)]
+        users = [u for u in dm.get_users() if not u.is_manager]
+
+        checked = set()
+        for b in bookings:
+            owner = b.owner
+            creatorId = b.application.creator_id if b.application else None
+            for u in users:
+                samePi = u.same_pi(owner)
+                if u.id in [owner.id, creatorId] or u == owner.get_pi() or samePi in checked:
+                    continue
+                serializer = BookingSerializer(dm, u)
+                for kwargs in [{}, {'prettyDate': True, 'piApp': True}]:
+                    e = serializer.to_event(b, **kwargs)
+                    self.assertEqual(booking_to_event_ref(dm, u, b, **kwargs), e)
+                    # Only users of the same lab can see the booking title
+                    self.assertEqual(e['booking_title'] == 'Hidden title', not samePi)
+                self.assertEqual([e['id'] for e in serializer.serialize([b, b])],
+                                 [b.id, b.id])
+                checked.add(samePi)
+
+        # Users with the same PI and with a different PI were checked
+        self.assertEqual(checked, {True, False})
+
     def test_count_booking_resources(self):
         print("=" * 80, "\nTesting counting booking resources...")
 
@@ -140,6 +204,69 @@ class TestDataManager(unittest.TestCase):
         self.assertFalse(all(m.requires_slot for m in microscopes))
 
 
+def booking_to_event_ref(dm, user, booking, **kwargs):
+    """ Calendar event of a booking as computed before BookingSerializer,
+    resolving the user, config and relations for each booking. """
+    resource = booking.resource
+    owner = booking.owner
+    operator = booking.operator
+    a = booking.application
+    b_title = booking.title
+
+    can_modify_list = [owner.id]
+    if a is not None:
+        can_modify_list.append(a.creator.id)
+    if user.is_manager and (a is None or a.allows_access(user)):
+        can_modify_list.append(user.id)
+    pi = owner.get_pi()
+    if pi is not None:
+        can_modify_list.append(pi.id)
+
+    user_can_modify = user.id in can_modify_list
+    user_can_view = user_can_modify or user.same_pi(owner)
+    color = resource.color
+
+    if booking.type == 'maintenance' or any(k in b_title for k in ['cycle', 'installation', 'maintenance', 'afis']):
+        color = 'rgba(255,107,53,1.0)'
+        title = "%s (MAINTENANCE): %s" % (resource.name, b_title)
+    else:
+        display = dm.get_config('bookings')['display']
+        emptyApp = a is None or not display['show_application']
+        appStr = '' if emptyApp else ', %s' % a.code
+        emptyPi = (owner.is_manager or owner.is_pi or
+                   pi is None or not display.get('show_pi', False))
+        piStr = '' if emptyPi else shortname(pi) + '/'
+        emptyOp = operator is None or not display.get('show_operator', False)
+        opStr = '' if emptyOp else ' -> ' + shortname(operator)
+        extra = "%s%s%s%s" % (piStr, shortname(owner), appStr, opStr)
+        if user_can_view:
+            title = "%s (%s) %s" % (resource.name, extra, b_title)
+        else:
+            title = "%s (%s)" % (resource.name, extra)
+            b_title = "Hidden title"
+
+    bd = {
+        'id': booking.id,
+        'title': title,
+        'resource': {'id': resource.id},
+        'start': datetime_to_isoformat(booking.start),
+        'end': datetime_to_isoformat(booking.end),
+        'color': color,
+        'textColor': 'white',
+        'booking_title': b_title,
+    }
+    if kwargs.get('prettyDate', False):
+        bd['pretty_start'] = pretty_datetime(booking.start)
+        bd['pretty_end'] = pretty_datetime(booking.end)
+    if kwargs.get('piApp', False):
+        if pi is not None:
+            bd['pi_id'] = pi.id
+            bd['pi_name'] = pi.name
+        if a is not None:
+            bd['app_id'] = a.id
+    return bd
+
+
 class TestDataLog(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -168,3 +295,152 @@ class TestDataLog(unittest.TestCase):
         logs = dl.get_logs()
         self.assertEqual(2, len(logs))
         dl.close()
+
+
+class MicrographsData(SessionData):
+    """ Processing project with the CTF values of some micrographs. """
+    def __init__(self, path, prefix, n):
+        SessionData.__init__(self, path)
+        self.mics = []
+        for i in range(n):
+            micName = 'GridSquare_%d/%s_%03d.mrc' % (i % 2, prefix, i)
+            os.makedirs(os.path.dirname(self.join(micName)), exist_ok=True)
+            open(self.join(micName), 'w').close()
+            self.mics.append({'micrograph': micName,
+                              'ctfDefocus': 10000 + i * 1000,
+                              'ctfDefocusAngle': 45,
+                              'ctfAstigmatism': 100,
+                              'ctfResolution': 3 + i})
+
+    def load_stats(self):
+        n = len(self.mics)
+        return {'movies': {'count': n}, 'ctfs': {'count': n}}
+
+    def get_micrographs(self, start=0):
+        return self.mics[start:]
+
+
+class TestSessionData(unittest.TestCase):
+    class Session:
+        id = 1
+
+        def json(self):
+            return {'id': self.id, 'status': 'active'}
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.app = flask.Flask(__name__)
+        self.app.dm = self
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def get_processing_project(self, **kwargs):
+        return {'project': self.sdata, 'args': kwargs}
+
+    def get_session_data(self, **kwargs):
+        with self.app.app_context():
+            return DataContent().get_session_data(self.Session(), **kwargs)
+
+    def test_delta(self):
+        self.sdata = MicrographsData(self.tmpDir, 'mic', 5)
+        data = self.get_session_data()
+        self.assertEqual(data['micrographs_count'], 5)
+        self.assertEqual(len(data['defocus']), 5)
+
+        delta = self.get_session_data(since=5, version=data['version'])
+        self.assertTrue(delta['unchanged'])
+
+        self.sdata.mics += MicrographsData(self.tmpDir, 'new', 7).mics[5:]
+        delta = self.get_session_data(since=5, version=data['version'])
+        self.assertEqual(delta['since'], 5)
+        self.assertEqual(delta['resolution'], [8, 9])
+
+        # CTF was run again and there are fewer micrographs than the
+        # client has, all values are sent for the client to replace its data
+        self.sdata = MicrographsData(self.tmpDir, 'rerun', 3)
+        data = self.get_session_data(since=7, version=delta['version'])
+        self.assertEqual(data['since'], 0)
+        self.assertEqual(data['micrographs_count'], 3)
+        self.assertEqual(data['resolution'], [3, 4, 5])
+
+    def test_ctf_store(self):
+        sdata = MicrographsData(self.tmpDir, 'mic', 5)
+        store = CtfStore(self.tmpDir)
+        self.assertEqual(store.update(sdata, 5), 5)
+        self.assertEqual(store.update(sdata, 5), 0)
+        self.assertEqual(store.gridsquares().tolist()[:2],
+                         ['GridSquare_0', 'GridSquare_1'])
+
+        # A count behind the files (e.g. from the summary) is not a rebuild
+        self.assertEqual(store.update(sdata, 3, grow_only=True), 0)
+        self.assertEqual(store.count, 5)
+
+        # The file written by another process (e.g. the indexer) is loaded
+        sdata.mics += MicrographsData(self.tmpDir, 'new', 7).mics[5:]
+        other = CtfStore(self.tmpDir)
+        self.assertEqual(other.update(sdata, 7), 2)
+        os.utime(other.path, (time.time() + 5, time.time() + 5))
+        self.assertEqual(store.update(sdata, 7), 0)
+        self.assertEqual(store.get('resolution').tolist()[5:], [8, 9])
+
+        # CTF was run again, even if the count is from the summary
+        sdata = MicrographsData(self.tmpDir, 'rerun', 3)
+        self.assertEqual(store.update(sdata, 3, grow_only=True), 3)
+        self.assertEqual(store.firstMic, sdata.mics[0]['micrograph'])
+
+
+class TestSessionSummary(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_versions(self):
+        sdata = MicrographsData(self.tmpDir, 'mic', 5)
+        summary = SessionSummary(self.tmpDir)
+        self.assertIsNone(summary.load())
+        self.assertEqual(sdata.get_stats()['ctfs']['count'], 5)
+
+        values = SessionSummary.build(sdata)
+        self.assertEqual(values['gridsquares'],
+                         [{'gsId': 'GridSquare_0', 'micrographs': 3},
+                          {'gsId': 'GridSquare_1', 'micrographs': 2}])
+        self.assertEqual(summary.write(values), 1)
+
+        loaded = summary.load()
+        self.assertEqual(loaded['version'], 1)
+        self.assertEqual(loaded['gridsquares'], values['gridsquares'])
+        self.assertEqual(loaded['classes2d_runs'], [])
+        self.assertEqual(sdata.get_stats(), dict(values['stats'], summary=1))
+        self.assertEqual(sdata.get_gridsquares(), values['gridsquares'])
+
+        # Same values, same version
+        self.assertEqual(summary.write(SessionSummary.build(sdata)), 1)
+
+        sdata.mics += MicrographsData(self.tmpDir, 'new', 7).mics[5:]
+        self.assertEqual(summary.write(SessionSummary.build(sdata)), 2)
+        self.assertEqual(sdata.get_stats()['summary'], 2)
+        self.assertEqual(sdata.get_stats()['ctfs']['count'], 7)
+
+    def test_max_age(self):
+        sdata = MicrographsData(self.tmpDir, 'mic', 5)
+        summary = SessionSummary(self.tmpDir)
+        summary.write(SessionSummary.build(sdata))
+        sdata.mics = sdata.mics[:4]
+
+        # The indexer is not running, values are read from the files
+        old = time.time() - SessionSummary.MAX_AGE - 10
+        os.utime(summary.path, (old, old))
+        self.assertIsNone(summary.load())
+        self.assertEqual(summary.load(max_age=float('inf'))['version'], 1)
+        stats = sdata.get_stats()
+        self.assertNotIn('summary', stats)
+        self.assertEqual(stats['ctfs']['count'], 4)
+
+        # Writing the same values again marks the summary as up to date
+        sdata.mics = MicrographsData(self.tmpDir, 'mic', 5).mics
+        self.assertEqual(summary.write(SessionSummary.build(sdata)), 1)
+        self.assertEqual(sdata.get_stats()['summary'], 1)
+
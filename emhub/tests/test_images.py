@@ -0,0 +1,267 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *
+# * [1] SciLifeLab, Stockholm University
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'delarosatrevin@scilifelab.se'
+# *
+# **************************************************************************
+
+import os
+import io
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import mrcfile
+import flask
+from PIL import Image
+
+from emhub.blueprints import images_bp
+from emhub.data.content import DataContent
+from emhub.data.processing.processing_relion import RelionSessionData
+from emhub.utils.image import ThumbnailCache
+
+
+class RunFolder:
+    """ Processing run with its outputs in a folder. """
+    def __init__(self, path):
+        self.path = path
+
+    def join(self, *paths):
+        return os.path.join(self.path, *paths)
+
+
+class ProjectUser:
+    """ User that can only see the processing projects of one entry. """
+    def __init__(self, entryId):
+        self.entryId = entryId
+
+    def can_edit_project(self, project):
+        return project.id == self.entryId
+
+    def same_pi(self, other):
+        return False
+
+
+class ProjectManager:
+    """ Provide the entries and processing project as DataManager does,
+    the run is always the same folder. """
+    class Entry:
+        def __init__(self, entryId):
+            self.id = entryId
+            self.project = self
+            self.user = None
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_entry_by(self, id):
+        return self.Entry(id)
+
+    def get_processing_project(self, **kwargs):
+        return {'project': None,
+                'args': {'entry_id': kwargs['entry_id'],
+                         'run_id': int(kwargs['run_id'])},
+                'run': RunFolder(self.path)}
+
+
+class TestVolumeRoutes(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+        # Volume with shape (z, y, x) = (8, 6, 4)
+        data = np.arange(8 * 6 * 4, dtype=np.float32).reshape(8, 6, 4)
+        with mrcfile.new(os.path.join(cls.tmpDir, 'volume.mrc')) as mrc:
+            mrc.set_data(data)
+            mrc.voxel_size = 1.5
+
+        app = flask.Flask(__name__)
+        app.config['LOGIN_DISABLED'] = True
+        app.register_blueprint(images_bp, url_prefix='/images')
+        app.dm = ProjectManager(cls.tmpDir)
+        app.user = ProjectUser(1)
+        app.thumbnails = ThumbnailCache(os.path.join(cls.tmpDir, 'thumbnails'))
+        cls.client = app.test_client()
+        cls.args = {'entry_id': 1, 'run_id': 1, 'volName': 'volume.mrc'}
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+
+    def test_volume_info(self):
+        r = self.client.get('/images/volume_info', query_string=self.args)
+        self.assertEqual(r.status_code, 200)
+        info = json.loads(r.data)
+        self.assertEqual(info['dimensions'], [4, 6, 8])
+        self.assertAlmostEqual(info['pixel_size'], 1.5)
+        self.assertEqual(info['range'], [0, 191])
+        self.assertIn('version', info)
+
+        r = self.client.get('/images/volume_info',
+                            query_string=dict(self.args, volName='missing.mrc'))
+        self.assertEqual(r.status_code, 404)
+
+        # Projects of other entries or from a path can not be accessed
+        r = self.client.get('/images/volume_info',
+                            query_string=dict(self.args, entry_id=2))
+        self.assertEqual(r.status_code, 403)
+        args = {'path': self.tmpDir, 'run_id': 1, 'volName': 'volume.mrc'}
+        r = self.client.get('/images/volume_info', query_string=args)
+        self.assertEqual(r.status_code, 400)
+
+    def test_volume_slice(self):
+        def _get(**kwargs):
+            return self.client.get('/images/volume_slice',
+                                   query_string=dict(self.args, **kwargs))
+
+        # Image size (width, height) of the slices along each axis
+        for axis, size in [('z', (4, 6)), ('y', (4, 8)), ('x', (6, 8))]:
+            r = _get(axis=axis, index=2)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.mimetype, 'image/png')
+            self.assertEqual(Image.open(io.BytesIO(r.data)).size, size)
+
+        # Already rendered slices are not sent again
+        etag = _get(axis='z', index=2).headers['ETag']
+        r = self.client.get('/images/volume_slice', headers={'If-None-Match': etag},
+                            query_string=dict(self.args, axis='z', index=2))
+        self.assertEqual(r.status_code, 304)
+
+        self.assertEqual(_get(axis='z', index=8).status_code, 404)
+        self.assertEqual(_get(axis='w', index=0).status_code, 400)
+        self.assertEqual(_get(axis='z', index='first').status_code, 400)
+        r = self.client.get('/images/volume_slice', query_string=self.args)
+        self.assertEqual(r.status_code, 400)  # missing index
+
+
+MICS_STAR = """
+# version 30001
+
+data_optics
+
+loop_
+_rlnOpticsGroupName #1
+_rlnOpticsGroup #2
+_rlnMicrographPixelSize #3
+opticsGroup1 1 1.000000
+
+# version 30001
+
+data_micrographs
+
+loop_
+_rlnMicrographName #1
+_rlnOpticsGroup #2
+_rlnCtfImage #3
+_rlnDefocusU #4
+_rlnDefocusV #5
+_rlnCtfAstigmatism #6
+_rlnDefocusAngle #7
+_rlnCtfMaxResolution #8
+{mic1} 1 CtfFind/job003/mic1.ctf:mrc 12000.0 11000.0 1000.0 45.0 3.5
+{mic2} 1 CtfFind/job003/mic2.ctf:mrc 13000.0 12000.0 1000.0 30.0 4.0
+"""
+
+PICK_STAR = """
+# version 30001
+
+data_coordinate_files
+
+loop_
+_rlnMicrographName #1
+_rlnMicrographCoordinates #2
+{mic1} AutoPick/job004/Movies/mic1_autopick.star
+{mic2} AutoPick/job004/Movies/mic2_autopick.star
+"""
+
+COORDS_STAR = """
+# version 30001
+
+data_
+
+loop_
+_rlnCoordinateX #1
+_rlnCoordinateY #2
+10.0 20.0
+30.0 40.0
+"""
+
+
+class SessionManager:
+    """ Provide a session processing project as DataManager does. """
+    def __init__(self, project):
+        self.project = project
+
+    def get_processing_project(self, **kwargs):
+        return {'project': self.project,
+                'args': {'session_id': int(kwargs['session_id'])}}
+
+
+class TestMicData(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpDir = tempfile.mkdtemp()
+
+        def _write(fn, text):
+            path = os.path.join(cls.tmpDir, fn)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(text)
+
+        mics = {}
+        for i in [1, 2]:
+            micFn = ('MotionCorr/job002/Movies/GridSquare_1/Data/'
+                     'FoilHole_%d_Data_1_1_20230101_000000.mrc' % i)
+            os.makedirs(os.path.dirname(os.path.join(cls.tmpDir, micFn)),
+                        exist_ok=True)
+            with mrcfile.new(os.path.join(cls.tmpDir, micFn)) as mrc:
+                mrc.set_data(np.zeros((16, 16), dtype=np.float32))
+            mics['mic%d' % i] = micFn
+            _write('AutoPick/job004/Movies/mic%d_autopick.star' % i, COORDS_STAR)
+
+        _write('CtfFind/job003/micrographs_ctf.star', MICS_STAR.format(**mics))
+        _write('AutoPick/job004/autopick.star', PICK_STAR.format(**mics))
+
+        app = flask.Flask(__name__)
+        app.config['LOGIN_DISABLED'] = True
+        app.register_blueprint(images_bp, url_prefix='/images')
+        app.dm = SessionManager(RelionSessionData(cls.tmpDir))
+        app.dc = DataContent()
+        cls.client = app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpDir)
+
+    def test_relion_session(self):
+        r = self.client.post('/images/get_mic_data',
+                             data={'session_id': 1, 'mic_id': 1})
+        self.assertEqual(r.status_code, 200)
+        mic = json.loads(r.data)
+        # Relion sessions have no CTF plot, but coordinates are kept
+        self.assertNotIn('ctfPlot', mic)
+        self.assertEqual(mic['coordinates'], [[10, 20], [30, 40]])
+        self.assertEqual(mic['gridSquare'], 'GridSquare_1')
+        self.assertAlmostEqual(mic['ctfDefocusU'], 1.2)
+        self.assertIn('micThumbUrl', mic)
+        self.assertIn('psdUrl', mic)
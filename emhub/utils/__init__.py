@@ -116,6 +116,34 @@ def pairname(user):
         return shortname(user)
 
 
+class LazyList:
+    """ List-like object whose items are only computed (by calling func)
+    the first time they are accessed. Useful to pass template parameters
+    that are not used by all templates.
+    """
+    def __init__(self, func):
+        self._func = func
+        self._items = None
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = list(self._func())
+        return self._items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+
 class NpJsonEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.integer):
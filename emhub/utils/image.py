@@ -24,13 +24,23 @@
 # *
 # **************************************************************************
 
+import os
 import io
+import math
+import functools
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import base64
 import mrcfile
 
 from PIL import Image, ImageEnhance, ImageOps
 
+from emtools.image import Thumbnail
+
 
 class Base64Converter:
     def __init__(self, **kwargs):
@@ -38,9 +48,9 @@ class Base64Converter:
         self.contrast_factor = kwargs.get('contrast_factor', None)
         self.scale = 1.0
 
-    def from_pil(self, pil_img):
+    def from_pil(self, pil_img, autocontrast=True):
         """ Convert a PIL image into Base64. """
-        if self.contrast_factor is not None:
+        if autocontrast and self.contrast_factor is not None:
             pil_img = ImageOps.autocontrast(pil_img, cutoff=self.contrast_factor)
 
         scale = 1.0
@@ -68,32 +78,521 @@ class Base64Converter:
 
         return encoded
 
-    def from_array(self, imageArray):
-        # imean = imageArray.mean()
-        # isd = imageArray.std()
-        iMax = imageArray.max()  # min(imean + 10 * isd, imageArray.max())
-        iMin = imageArray.min()  # max(imean - 10 * isd, imageArray.min())
-        im255 = ((imageArray - iMin) / (iMax - iMin) * 255).astype(np.uint8)
+    def bin_factor(self, shape):
+        """ Integer binning factor that keeps the image bigger than
+        max_size, so PIL only needs to do the final (small) resize.
+        """
+        if self.max_size is None:
+            return 1
+        h, w = shape
+        mw, mh = self.max_size
+        return max(1, int(max(h / mh, w / mw)))
+
+    def from_array(self, imageArray, fast=True):
+        """ Convert a 2D array into Base64.
+
+        In the fast path, the array is first binned by an integer factor
+        (with a reshape-mean), then the contrast is computed from the
+        percentiles of the small array (as PIL autocontrast would do with
+        the same cutoff) and it is scaled in place. This avoids creating
+        several full-size temporary arrays for big micrographs.
+        """
+        if not fast:
+            # imean = imageArray.mean()
+            # isd = imageArray.std()
+            iMax = imageArray.max()  # min(imean + 10 * isd, imageArray.max())
+            iMin = imageArray.min()  # max(imean - 10 * isd, imageArray.min())
+            im255 = ((imageArray - iMin) / (iMax - iMin) * 255).astype(np.uint8)
+            return self.from_pil(Image.fromarray(im255))
+
+        f = self.bin_factor(imageArray.shape)
+        if f > 1:
+            h, w = imageArray.shape
+            h, w = h // f, w // f
+            small = imageArray[:h * f, :w * f].reshape(h, f, w, f).mean(
+                axis=(1, 3), dtype=np.float32)
+        else:
+            small = np.array(imageArray, dtype=np.float32)
+
+        if self.contrast_factor:
+            c = self.contrast_factor
+            iMin, iMax = np.percentile(small, [c, 100 - c])
+        else:
+            iMin, iMax = small.min(), small.max()
 
-        pil_img = Image.fromarray(im255)
+        small -= iMin
+        small *= 255 / max(iMax - iMin, np.finfo(np.float32).eps)
+        np.clip(small, 0, 255, out=small)
 
-        return self.from_pil(pil_img)
+        encoded = self.from_pil(Image.fromarray(small.astype(np.uint8)),
+                                autocontrast=False)
+        self.scale *= f
+        return encoded
 
     def from_mrc(self, mrc_path):
         """ Convert real float32 mrc to base64.
         Convert to int8 first, then scale with Pillow.
         """
-        mrc_img = mrcfile.open(mrc_path, permissive=True)
+        with mrcfile.mmap(mrc_path, mode='r', permissive=True) as mrc_img:
+            if mrc_img.data.ndim == 3:
+                imfloat = mrc_img.data[0, :, :]
+            else:
+                imfloat = mrc_img.data
+
+            return self.from_array(imfloat)
+
+class ThumbnailCache:
+    """ Keep resized versions of images on disk.
+
+    Thumbnails are stored in cacheDir using a key computed from the
+    source path, its modification time and size, and the thumbnail
+    parameters. So, if the source image changes, a new thumbnail will
+    be generated (and old ones are just not used anymore).
+
+    If max_bytes is given, the least recently used thumbnails are removed
+    when the cache goes over that quota. The mtime of cached files is
+    updated on every hit, so it is used as the last access time.
+
+    If root is given, paths are relative to it in the keys. This is used
+    for the shared cache inside processing projects, where thumbnails
+    are written by the session worker and the project folder might be
+    mounted in a different location in the web server.
+    """
+    FORMATS = {'png': 'PNG', 'jpeg': 'JPEG', 'webp': 'WEBP'}
+
+    # Folder of the shared thumbnails cache inside a processing project
+    SHARED_FOLDER = 'emhub_thumbnails'
+
+    def __init__(self, cacheDir, max_bytes=None, root=None):
+        self.cacheDir = cacheDir
+        self.max_bytes = max_bytes
+        self.root = root
+        self._total = None  # estimated size of the cache, computed on first write
+        os.makedirs(cacheDir, exist_ok=True)
+
+    @classmethod
+    def shared(cls, projectPath, create=False):
+        """ Return the shared cache of a processing project, or None if
+        it does not exist and create is False.
+        """
+        cacheDir = os.path.join(projectPath, cls.SHARED_FOLDER)
+        if not create and not os.path.exists(cacheDir):
+            return None
+        return cls(cacheDir, root=projectPath)
+
+    def get_key(self, path, **params):
+        """ Key from path, mtime and size of the file and the params. """
+        st = os.stat(path)
+        keyPath = (os.path.relpath(path, self.root) if self.root
+                   else os.path.abspath(path))
+        keyStr = '%s:%s:%s' % (keyPath, st.st_mtime_ns, st.st_size)
+        for k in sorted(params):
+            keyStr += ':%s=%s' % (k, params[k])
+        return hashlib.sha1(keyStr.encode()).hexdigest()
+
+    def _cache_path(self, key, ext):
+        # Use a subfolder from the key prefix to avoid too many files in one folder
+        return os.path.join(self.cacheDir, key[:2], '%s.%s' % (key, ext))
+
+    def write(self, cachePath, data):
+        """ Write data in cachePath atomically, so other processes
+        never read a partially written file. """
+        folder = os.path.dirname(cachePath)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmpPath, cachePath)
+        except:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+        if self.max_bytes:
+            if self._total is None:
+                self._total = sum(e[2] for e in self._entries())
+            else:
+                self._total += len(data)
+            if self._total > self.max_bytes:
+                self.evict()
+
+    def _entries(self):
+        """ Iterate over (path, mtime, size) of all cached files. """
+        with os.scandir(self.cacheDir) as folders:
+            for folder in folders:
+                if not folder.is_dir():
+                    continue
+                with os.scandir(folder.path) as files:
+                    for f in files:
+                        if f.is_file() and not f.name.endswith('.tmp'):
+                            st = f.stat()
+                            yield f.path, st.st_mtime, st.st_size
+
+    def evict(self, max_bytes=None):
+        """ Remove the least recently used files until the cache size
+        is under 90% of max_bytes (or self.max_bytes). """
+        max_bytes = max_bytes or self.max_bytes
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(e[2] for e in entries)
+        limit = int(max_bytes * 0.9)
 
-        if mrc_img.is_volume():
-            imfloat = mrc_img.data[0, :, :]
+        for path, _, size in entries:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:  # maybe removed by other process
+                total -= size
+
+        self._total = total
+        return total
+
+    def touch(self, cachePath):
+        """ Mark the file as recently used. """
+        try:
+            os.utime(cachePath)
+        except OSError:
+            pass
+
+    @classmethod
+    def encode(cls, pil_img, format):
+        """ Encode the PIL image in one of the supported formats. """
+        if format not in cls.FORMATS:
+            raise Exception("Unsupported image format: %s" % format)
+        if format == 'jpeg' and pil_img.mode not in ('RGB', 'L'):
+            pil_img = pil_img.convert('RGB')
+        img_io = io.BytesIO()
+        pil_img.save(img_io, format=cls.FORMATS[format])
+        return img_io.getvalue()
+
+    def get(self, path, render, format='png', **params):
+        """ Return the cached thumbnail of path, rendering it if needed.
+
+        Args:
+            path: source image path (used for the key with its mtime and size)
+            render: function that receives the path and returns a PIL image
+            format: output format (png, jpeg or webp)
+            params: render parameters, they are also part of the key
+
+        Returns:
+            (cachePath, key) tuple, the key can be used as ETag.
+        """
+        key = self.get_key(path, format=format, **params)
+        cachePath = self._cache_path(key, format)
+
+        if os.path.exists(cachePath):
+            if self.max_bytes:
+                self.touch(cachePath)
         else:
-            imfloat = mrc_img.data
+            self.write(cachePath, self.encode(render(path), format))
+
+        return cachePath, key
+
+    def lookup(self, path, format='png', **params):
+        """ Same as get, but never render the thumbnail.
+
+        Returns:
+            (cachePath, key) tuple, cachePath is None if not in the cache.
+        """
+        key = self.get_key(path, format=format, **params)
+        cachePath = self._cache_path(key, format)
+        return (cachePath if os.path.exists(cachePath) else None), key
+
+    def get_array(self, path, load, **params):
+        """ Same as get, but for NumPy arrays (e.g. plots data) returned
+        by load(path) and stored as .npy files.
+
+        Returns:
+            the cached array
+        """
+        key = self.get_key(path, format='npy', **params)
+        cachePath = self._cache_path(key, 'npy')
+
+        if os.path.exists(cachePath):
+            if self.max_bytes:
+                self.touch(cachePath)
+            return np.load(cachePath)
+
+        array = load(path)
+        arrayIO = io.BytesIO()
+        np.save(arrayIO, array)
+        self.write(cachePath, arrayIO.getvalue())
+        return array
+
+    def get_path(self, path, max_size=(128, 128), format='png'):
+        """ Return the path of the thumbnail of the given image,
+        generating it if it does not exist yet.
+        """
+        def _render(path):
+            img = Image.open(path)
+            img.thumbnail(max_size)
+            return img
+
+        return self.get(path, _render, format=format, max_size=max_size)[0]
+
+
+# Number of points of the CTF profiles sent to the browser
+CTF_PROFILE_POINTS = 256
+
+
+def ctf_profile_path(psdFile):
+    """ Return the CTF profile file (_avrot.txt from ctffind) of a PSD. """
+    return os.path.splitext(psdFile)[0] + '_avrot.txt'
+
+
+def load_ctf_profile(path, cache=None, points=CTF_PROFILE_POINTS):
+    """ Load a ctffind _avrot.txt file, with one row of values per curve
+    (spatial frequency, rotational averages, CTF fit, etc), as a float32
+    array down-sampled to a maximum number of points.
+
+    If cache is given (e.g. the shared cache of the project), the array is
+    stored there, next to the micrograph thumbnails.
+
+    Returns:
+        the array or None if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+
+    def _load(p):
+        values = np.loadtxt(p, comments='#', dtype=np.float32, ndmin=2)
+        n = values.shape[1]
+        if n > points:
+            values = values[:, np.linspace(0, n - 1, points).round().astype(int)]
+        return values
+
+    if cache is None:
+        return _load(path)
+    return cache.get_array(path, _load, kind='ctf_profile', points=points)
+
+
+def ctf_profile_list(values, decimals=4):
+    """ Convert the CTF profile array to nested lists of rounded floats,
+    to be sent as compact JSON. """
+    return [] if values is None else np.round(values.astype(np.float64), decimals).tolist()
+
+
+# Default size and format for each type of rendered thumbnail
+THUMBNAIL_KINDS = {
+    'micrograph': {'size': 512, 'format': 'jpeg', 'contrast': 0.15},
+    'psd': {'size': 128, 'format': 'png', 'contrast': 1},
+    'class2d': {'size': 100, 'format': 'png', 'contrast': None},
+    'class2d_sprite': {'size': 100, 'format': 'png', 'contrast': None},
+    'image': {'size': 512, 'format': 'jpeg', 'contrast': None}
+}
+
+
+def render_thumbnail(path, kind, size, index=0, contrast=None):
+    """ Render a thumbnail of the given kind as a PIL image.
+
+    Args:
+        path: input file, an MRC file except for 'image' kind
+        kind: one of the THUMBNAIL_KINDS
+        size: max size (width and height) of the thumbnail
+        index: image index in the stack (only used for 'class2d')
+            'class2d_sprite' renders all images of the stack in a sheet
+        contrast: autocontrast cutoff, if None the kind's default is used
+    """
+    max_size = (size, size)
+    if contrast is None:
+        contrast = THUMBNAIL_KINDS[kind]['contrast']
+
+    if kind == 'micrograph':
+        return Thumbnail.Micrograph(output_format=None, max_size=max_size,
+                                    contrast_factor=contrast).from_mrc(path)
+    elif kind == 'psd':
+        return Thumbnail.Psd(output_format=None, max_size=max_size,
+                             contrast_factor=contrast).from_mrc(path)
+    elif kind == 'class2d':
+        with mrcfile.mmap(path, mode='r', permissive=True) as mrc:
+            data = mrc.data if mrc.data.ndim == 2 else mrc.data[index]
+            return Thumbnail(output_format=None, max_size=max_size,
+                             contrast_factor=contrast).from_array(data)
+    elif kind == 'class2d_sprite':
+        return render_sprite(path, size, contrast=contrast)
+    elif kind == 'image':
+        img = Image.open(path)
+        img.load()
+        return Thumbnail(output_format=None, max_size=max_size,
+                         contrast_factor=contrast).from_pil(img)
+
+    raise Exception("Unknown thumbnail kind: %s" % kind)
+
+
+def sprite_tiles(n, size):
+    """ Return the (x, y, width, height) of the n tiles of a sprite sheet,
+    with square tiles of the given size, in rows of ceil(sqrt(n)) tiles. """
+    cols = max(1, math.ceil(math.sqrt(n)))
+    return [((i % cols) * size, (i // cols) * size, size, size) for i in range(n)]
+
+
+def stack_size(path):
+    """ Number of images in an MRC stack, only the header is read. """
+    with mrcfile.open(path, header_only=True, permissive=True) as mrc:
+        return int(mrc.header.nz)
+
+
+def _render_tiles(path, indexes, size, contrast):
+    """ Render some images of a stack, this runs in the sprites pool. """
+    return [render_thumbnail(path, 'class2d', size, index=i, contrast=contrast)
+            for i in indexes]
+
+
+_sprites_pool = None
+_sprites_pool_lock = threading.Lock()
+
+
+def _get_sprites_pool(workers):
+    """ Create the pool of processes to render sprites on first use.
+    Processes are started with 'spawn', since forking a threaded web
+    server process could copy locks held by other threads. """
+    global _sprites_pool
+
+    with _sprites_pool_lock:
+        if _sprites_pool is None:
+            _sprites_pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _sprites_pool
+
+
+def render_sprite(path, size, contrast=None, workers=4):
+    """ Render all images of a stack (e.g. 2D class averages) into a single
+    sheet, the tiles are given by sprite_tiles. Images are rendered in a
+    pool of processes, with a chunk of the stack for each one.
+    """
+    n = stack_size(path)
+    if n == 0:
+        return Image.new('L', (size, size))
+
+    tiles = sprite_tiles(n, size)
+    chunk = max(1, math.ceil(n / workers))
+    chunks = [list(range(i, min(i + chunk, n))) for i in range(0, n, chunk)]
+
+    results = _get_sprites_pool(workers).map(_render_tiles, [path] * len(chunks), chunks,
+                                [size] * len(chunks), [contrast] * len(chunks))
+
+    sheet = Image.new('L', (max(t[0] + t[2] for t in tiles),
+                            max(t[1] + t[3] for t in tiles)))
+    for indexes, images in zip(chunks, results):
+        for i, img in zip(indexes, images):
+            x, y, w, h = tiles[i]
+            # Center the image in the tile if it is not square
+            sheet.paste(img.convert('L'),
+                        (x + (w - img.width) // 2, y + (h - img.height) // 2))
+    return sheet
+
+
+def thumbnail_params(kind, size=None, format=None, index=0, contrast=None):
+    """ Return the parameters (also used for the cache key) of a thumbnail,
+    using the kind's defaults for the ones that are None. The web server
+    and the session worker use this to produce the same keys.
+    """
+    defaults = THUMBNAIL_KINDS[kind]
+    return {
+        'format': format or defaults['format'],
+        'kind': kind,
+        'size': int(size or defaults['size']),
+        'index': int(index),
+        'contrast': defaults['contrast'] if contrast is None else float(contrast)
+    }
+
+
+def mrc_data_range(mrc, chunk=16):
+    """ Return the (min, max) of the data of an open MRC file.
+
+    The values from the header are used if they look valid, if not,
+    they are computed reading a few sections at a time, so memory usage
+    does not depend on the volume size when the file is memory-mapped.
+    """
+    h = mrc.header
+    dmin, dmax = float(h.dmin), float(h.dmax)
+    if np.isfinite(dmin) and np.isfinite(dmax) and dmax > dmin:
+        return dmin, dmax
+
+    data = mrc.data
+    if data.ndim == 2:
+        return float(data.min()), float(data.max())
+
+    dmin, dmax = np.inf, -np.inf
+    for i in range(0, data.shape[0], chunk):
+        block = data[i:i + chunk]
+        dmin = min(dmin, float(block.min()))
+        dmax = max(dmax, float(block.max()))
+    return dmin, dmax
+
+
+# Axis of the (z, y, x) volume data for the slices along x, y or z
+VOLUME_AXES = {'x': 2, 'y': 1, 'z': 0}
+
+
+@functools.lru_cache(maxsize=64)
+def _volume_range(path, mtime, size):
+    with mrcfile.mmap(path, mode='r', permissive=True) as mrc:
+        return mrc_data_range(mrc)
+
+
+def volume_data_range(path):
+    """ (min, max) of a volume, kept in memory while the file does
+    not change, since computing it could require reading the whole volume
+    if the header values are not valid. """
+    st = os.stat(path)
+    return _volume_range(path, st.st_mtime, st.st_size)
+
+
+def volume_info(path):
+    """ Return the dimensions (x, y, z), pixel size and data range of
+    an MRC volume. The data is memory-mapped, so only the header is read
+    (unless the range in the header is not valid).
+    """
+    with mrcfile.mmap(path, mode='r', permissive=True) as mrc:
+        shape = mrc.data.shape if mrc.data.ndim == 3 else (1,) + mrc.data.shape
+        zdim, ydim, xdim = shape
+        pixelSize = float(mrc.voxel_size.x)
+
+    return {
+        'dimensions': [xdim, ydim, zdim],
+        'pixel_size': pixelSize,
+        'range': list(volume_data_range(path))
+    }
+
+
+def render_volume_slice(path, axis, index, size, min_max=None):
+    """ Render a single slice of a volume as a PIL image.
+
+    Args:
+        path: MRC volume, memory-mapped, so only the slice is read
+        axis: 'x', 'y' or 'z', the slice is perpendicular to this axis
+        index: slice index along the axis
+        size: max size (width and height) of the image
+        min_max: range used to scale the values, the range of the whole
+            volume by default, so all slices have the same contrast
+    """
+    iMin, iMax = min_max or volume_data_range(path)
+    scale = 255 / max(iMax - iMin, np.finfo(np.float32).eps)
+
+    with mrcfile.mmap(path, mode='r', permissive=True) as mrc:
+        data = mrc.data if mrc.data.ndim == 3 else mrc.data[np.newaxis]
+        a = VOLUME_AXES[axis]
+        if not 0 <= index < data.shape[a]:
+            raise Exception("Invalid slice %s for axis %s, volume shape: %s"
+                            % (index, axis, data.shape))
+        section = np.take(data, index, axis=a)
+        im255 = np.clip((section - iMin) * scale, 0, 255).astype(np.uint8)
+
+    return Thumbnail(output_format=None,
+                     max_size=(size, size)).from_pil(Image.fromarray(im255))
 
-        result = self.from_array(imfloat)
-        mrc_img.close()
 
-        return result
+def thumbnail_scale(mrcPath, size):
+    """ Return the scale factor between an MRC image and its thumbnail
+    of the given max size. Only the header of the file is read.
+    """
+    with mrcfile.open(mrcPath, header_only=True, permissive=True) as mrc:
+        w, h = int(mrc.header.nx), int(mrc.header.ny)
+    factor = min(size / w, size / h, 1.0)
+    return w / max(1, round(w * factor))
 
 #
 # def fn_to_blob(filename):